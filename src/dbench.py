@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017, DjaoDjin inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks for the drop scripts, run from a source tree.
+
+The startup command measures how long the scripts take before they do
+any useful work, cold (no bytecode cache) and warm, and breaks down
+the time spent in the first steps of a dws command.
+
+The versions command times the extraction of version numbers from
+the `--help` output of typical prerequisites.
+"""
+
+__version__ = None
+
+import argparse, json, os, re, shutil, subprocess, sys, tempfile, time
+
+import tero
+
+# Directory where the scripts live in the source tree.
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scripts, as installed by the Makefile, and the source file they
+# are generated from.
+SCRIPTS = {
+    'dws': os.path.join('tero', '__init__.py'),
+    'dcopylogs': 'dcopylogs.py',
+    'dservices': 'dservices.py',
+    'dtero': 'dtero.py',
+    'duploades': 'duploades.py'
+}
+
+# Lines printed on stderr by `python -X importtime`.
+IMPORTTIME_PAT = re.compile(
+    r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+# Script run in a fresh interpreter to time the first steps of a dws
+# command. It prints a JSON dictionary of durations in seconds.
+BREAKDOWN_SCRIPT = """
+import json, sys, time
+durations = {}
+def timed(name, func):
+    start = time.time()
+    try:
+        result = func()
+    except Exception as err:
+        durations[name + ' error'] = str(err)
+        result = None
+    durations[name] = time.time() - start
+    return result
+tero = timed('import tero', lambda: __import__('tero'))
+dist = timed('HostPlatform.configure',
+    lambda: tero.HostPlatform('distHost').configure(None))
+tero.CONTEXT = timed('Context.__init__', tero.Context)
+if tero.CONTEXT and sys.argv[1]:
+    timed('IndexProjects.parse', lambda: tero.IndexProjects(
+        tero.CONTEXT, sys.argv[1]).parse(tero.PdbHandler()))
+sys.stdout.write(json.dumps(durations))
+"""
+
+# Excerpts of `gcc --help`, `git --help` and `bzip2 --help` outputs, the kind
+# of text *tero.bin_version_candidates* scans for version numbers.
+HELP_SAMPLES = {
+    'gcc': """Usage: gcc [options] file...
+Options:
+  -pass-exit-codes         Exit with highest error code from a phase.
+  --help                   Display this information.
+  --target-help            Display target specific command line options.
+  --help={common|optimizers|params|target|warnings|[^]{joined|separate|undocumented}}[,...].
+                           Display specific types of command line options.
+  --version                Display compiler version information.
+  -dumpspecs               Display all of the built in spec strings.
+  -dumpversion             Display the version of the compiler.
+  -dumpmachine             Display the compiler's target processor.
+  -print-search-dirs       Display the directories in the compiler's search path.
+  -print-libgcc-file-name  Display the name of the compiler's companion library.
+  -print-file-name=<lib>   Display the full path to library <lib>.
+  -print-prog-name=<prog>  Display the full path to compiler component <prog>.
+  -print-multiarch         Display the target's normalized GNU triplet, used as
+                           a component in the library path.
+  -Wa,<options>            Pass comma-separated <options> on to the assembler.
+  -Wp,<options>            Pass comma-separated <options> on to the preprocessor.
+  -Wl,<options>            Pass comma-separated <options> on to the linker.
+  -Xassembler <arg>        Pass <arg> on to the assembler.
+  -save-temps              Do not delete intermediate files.
+  -std=<standard>          Assume that the input sources are for <standard>.
+  -B <directory>           Add <directory> to the compiler's search paths.
+  -v                       Display the programs invoked by the compiler.
+  -E                       Preprocess only; do not compile, assemble or link.
+  -S                       Compile only; do not assemble or link.
+  -c                       Compile and assemble, but do not link.
+  -o <file>                Place the output into <file>.
+  -pie                     Create a dynamically linked position independent
+                           executable.
+  -x <language>            Specify the language of the following input files.
+                           Permissible languages include: c c++ assembler none
+For bug reporting instructions, please see:
+<file:///usr/share/doc/gcc-9/README.Bugs>.
+gcc (Ubuntu 9.4.0-1ubuntu1~20.04.2) 9.4.0
+""",
+    'git': """usage: git [--version] [--help] [-C <path>] [-c <name>=<value>]
+           [--exec-path[=<path>]] [--html-path] [--man-path] [--info-path]
+           [-p | --paginate | -P | --no-pager] [--no-replace-objects] [--bare]
+           [--git-dir=<path>] [--work-tree=<path>] [--namespace=<name>]
+           <command> [<args>]
+
+These are common Git commands used in various situations:
+
+start a working area (see also: git help tutorial)
+   clone             Clone a repository into a new directory
+   init              Create an empty Git repository or reinitialize an existing one
+
+work on the current change (see also: git help everyday)
+   add               Add file contents to the index
+   mv                Move or rename a file, a directory, or a symlink
+   restore           Restore working tree files
+   rm                Remove files from the working tree and from the index
+
+examine the history and state (see also: git help revisions)
+   bisect            Use binary search to find the commit that introduced a bug
+   diff              Show changes between commits, commit and working tree, etc
+   grep              Print lines matching a pattern
+   log               Show commit logs
+   show              Show various types of objects
+   status            Show the working tree status
+
+grow, mark and tweak your common history
+   branch            List, create, or delete branches
+   commit            Record changes to the repository
+   merge             Join two or more development histories together
+   rebase            Reapply commits on top of another base tip
+   reset             Reset current HEAD to the specified state
+   switch            Switch branches
+   tag               Create, list, delete or verify a tag object signed with GPG
+
+collaborate (see also: git help workflows)
+   fetch             Download objects and refs from another repository
+   pull              Fetch from and integrate with another repository or a local branch
+   push              Update remote refs along with associated objects
+
+'git help -a' and 'git help -g' list available subcommands and some
+concept guides. See 'git help <command>' or 'git help <concept>'
+to read about a specific subcommand or concept.
+See 'git help git' for an overview of the system.
+""",
+    'bzip2': """bzip2, a block-sorting file compressor.  Version 1.0.8, 13-Jul-2019.
+
+   usage: bzip2 [flags and input files in any order]
+
+   -h --help           print this message
+   -d --decompress     force decompression
+   -z --compress       force compression
+   -k --keep           keep (don't delete) input files
+   -f --force          overwrite existing output files
+   -t --test           test compressed file integrity
+   -c --stdout         output to standard out
+   -q --quiet          suppress noncritical error messages
+   -v --verbose        be verbose (a 2nd -v gives more)
+   -L --license        display software version & license
+   -V --version        display software version & license
+   -s --small          use less memory (at most 2500k)
+   -1 .. -9            set block size to 100k .. 900k
+   --fast              alias for -1
+   --best              alias for -9
+
+   If invoked as `bzip2', default action is to compress.
+              as `bunzip2',  default action is to decompress.
+              as `bzcat', default action is to decompress to stdout.
+"""
+}
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _run(cmdline, pycache_prefix):
+    '''Runs *cmdline* and returns its wall time, stdout and stderr.'''
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC_DIR] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    env['PYTHONPYCACHEPREFIX'] = pycache_prefix
+    # Warm runs need the bytecode cache written by previous runs.
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = time.time()
+    cmd = subprocess.Popen(cmdline, env=env, cwd=SRC_DIR,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = cmd.communicate()
+    return (time.time() - start, cmd.returncode,
+        output.decode('utf-8', 'replace'), errors.decode('utf-8', 'replace'))
+
+
+def parse_importtime(text, top=10):
+    '''Returns the total import time and the *top* slowest top-level
+    imports reported by `python -X importtime` in *text* (microseconds).'''
+    imports = []
+    for line in text.splitlines():
+        look = IMPORTTIME_PAT.match(line)
+        if look and len(look.group(3)) <= 1:
+            imports += [(int(look.group(2)), look.group(4))]
+    imports.sort(reverse=True)
+    return (sum([cumulative for cumulative, _ in imports]),
+        [{'module': name, 'cumulative_us': cumulative}
+         for cumulative, name in imports[:top]])
+
+
+def measure_script(name, runs=5):
+    '''Measures the startup of script *name* through `--version`.'''
+    cmdline = [sys.executable,
+        os.path.join(SRC_DIR, SCRIPTS[name]), '--version']
+    result = {'cold': [], 'warm': []}
+    warm_prefix = tempfile.mkdtemp(prefix='pycache-')
+    try:
+        # Warm up the bytecode cache used by warm runs. Import times
+        # are reported by a separate run since `-X importtime` itself
+        # slows down the startup.
+        _, _, _, importtime = _run(
+            cmdline[:1] + ['-X', 'importtime'] + cmdline[1:], warm_prefix)
+        for _ in range(0, runs):
+            cold_prefix = tempfile.mkdtemp(prefix='pycache-')
+            try:
+                elapsed, code, _, errors = _run(cmdline, cold_prefix)
+            finally:
+                shutil.rmtree(cold_prefix)
+            result['cold'] += [elapsed]
+            elapsed, code, _, errors = _run(cmdline, warm_prefix)
+            result['warm'] += [elapsed]
+    finally:
+        shutil.rmtree(warm_prefix)
+    if code != 0:
+        # For example, duploades requires boto which might not be installed.
+        result['error'] = errors.strip().splitlines()[-1] if errors else code
+    result['cold_median'] = _median(result['cold'])
+    result['warm_median'] = _median(result['warm'])
+    result['import_us'], result['imports'] = parse_importtime(importtime)
+    return result
+
+
+def measure_breakdown(index=None, runs=5):
+    '''Times the import of tero, host platform detection, the creation
+    of a Context and the first parse of the project *index*.'''
+    durations = {}
+    cmdline = [sys.executable, '-c', BREAKDOWN_SCRIPT, index if index else '']
+    prefix = tempfile.mkdtemp(prefix='pycache-')
+    try:
+        # Warm up the bytecode cache such that we time the code itself.
+        _run(cmdline, prefix)
+        for _ in range(0, runs):
+            _, code, output, errors = _run(cmdline, prefix)
+            if code != 0:
+                return {'error': errors.strip()}
+            for key, val in tero._iteritems(json.loads(output)):
+                if key.endswith(' error'):
+                    durations[key] = val
+                else:
+                    durations.setdefault(key, []).append(val)
+    finally:
+        shutil.rmtree(prefix)
+    for key in list(durations.keys()):
+        if isinstance(durations[key], list):
+            durations[key] = _median(durations[key])
+    return durations
+
+
+def pub_startup(scripts, runs=5, output=None, budget=[], index=None):
+    '''[ script ... ]
+    Measures cold and warm startup of each *script* (all of them
+    by default) over *runs* runs, records the results as JSON
+    in *output* (or stdout) and exits with an error when a median
+    warm start exceeds the budget.
+    --budget  [script=]milliseconds, maximum median warm start
+              of *script* (or of all scripts).
+    --index   project index file to use for the timing
+              of the first IndexProjects.parse.'''
+    runs = int(runs)
+    if not scripts:
+        scripts = sorted(SCRIPTS.keys())
+    if not index and os.path.isfile(
+            os.path.join(os.path.dirname(SRC_DIR), 'dws.xml')):
+        index = os.path.join(os.path.dirname(SRC_DIR), 'dws.xml')
+    budgets = {}
+    for item in budget or []:
+        if '=' in item:
+            name, limit = item.split('=')
+            budgets[name] = float(limit) / 1000
+        else:
+            for name in scripts:
+                budgets.setdefault(name, float(item) / 1000)
+    results = {'python': sys.version.split()[0], 'runs': runs,
+               'scripts': {}, 'breakdown': measure_breakdown(index, runs)}
+    over_budget = []
+    for name in scripts:
+        if not name in SCRIPTS:
+            raise tero.Error("unknown script '%s'" % name)
+        result = measure_script(name, runs)
+        if name in budgets:
+            result['budget'] = budgets[name]
+            if result['warm_median'] > budgets[name]:
+                over_budget += [name]
+        results['scripts'][name] = result
+        sys.stderr.write("%s: cold %.0fms, warm %.0fms\n" % (name,
+            result['cold_median'] * 1000, result['warm_median'] * 1000))
+    for key, val in sorted(results['breakdown'].items()):
+        if isinstance(val, float):
+            sys.stderr.write("%s: %.1fms\n" % (key, val * 1000))
+        else:
+            sys.stderr.write("%s: %s\n" % (key, val))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    if over_budget:
+        raise tero.Error("over budget: %s" % ', '.join([
+            "%s (%.0fms > %.0fms)" % (name,
+                results['scripts'][name]['warm_median'] * 1000,
+                budgets[name] * 1000) for name in over_budget]))
+
+
+def measure_versions(text, runs=5, loops=100):
+    '''Returns the median time (seconds) *tero.version_candidates*
+    takes to scan all lines in *text*, and the candidates found.'''
+    lines = text.splitlines()
+    durations = []
+    for _ in range(0, runs):
+        start = time.time()
+        for _ in range(0, loops):
+            numbers = []
+            for line in lines:
+                numbers += tero.version_candidates(line)
+        durations += [(time.time() - start) / loops]
+    return _median(durations), numbers
+
+
+def pub_versions(runs=5, output=None, budget=None):
+    '''
+    Measures the extraction of version numbers from typical `--help`
+    outputs over *runs* runs, records the results as JSON in *output*
+    (or stdout) and exits with an error when a median exceeds the budget.
+    --budget  microseconds, maximum median time to scan one output.'''
+    runs = int(runs)
+    results = {'python': sys.version.split()[0], 'runs': runs, 'samples': {}}
+    over_budget = []
+    for name, text in sorted(HELP_SAMPLES.items()):
+        elapsed, numbers = measure_versions(text, runs)
+        results['samples'][name] = {'median': elapsed, 'candidates': numbers}
+        if budget and elapsed > float(budget) / 1000000:
+            over_budget += [name]
+        sys.stderr.write("%s: %.1fus %s\n" % (name, elapsed * 1000000,
+            ' '.join(numbers)))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    if over_budget:
+        raise tero.Error("over budget: %s" % ', '.join([
+            "%s (%.1fus > %sus)" % (name,
+                results['samples'][name]['median'] * 1000000, budget)
+            for name in over_budget]))
+
+
+def main(args):
+    '''Main Entry Point'''
+    import __main__
+
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s [options] command\n\nVersion\n  %(prog)s version '
+        + str(__version__),
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--version', action='version',
+        version='%(prog)s ' + str(__version__))
+    tero.build_subcommands_parser(parser, __main__, args[1:])
+    options = parser.parse_args(args[1:])
+    # Filter out options with are not part of the function prototype.
+    func_args = tero.filter_subcommand_args(options.func, options)
+    try:
+        options.func(**func_args)
+    except tero.Error as err:
+        # Error messages usually end with a newline, not always.
+        sys.stderr.write(str(err).rstrip('\n') + '\n')
+        return err.code
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
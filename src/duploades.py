@@ -479,7 +479,7 @@ def main():
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('--version', action='version',
         version='%(prog)s ' + str(tero.__version__))
-    tero.build_subcommands_parser(parser, __main__)
+    tero.build_subcommands_parser(parser, __main__, sys.argv[1:])
     args = parser.parse_args()
 
     # Filter out options with are not part of the function prototype.
@@ -50,10 +50,12 @@ from __future__ import unicode_literals
 
 __version__ = None
 
-import datetime, getpass, hashlib, inspect, json, locale
-import logging, logging.config
-import re, optparse, os, shutil, socket, stat, subprocess, sys, tempfile
-import xml.dom.minidom, xml.sax
+# Modules that are slow to import and only used by a few commands
+# (ex: inspect, logging.config, urllib.request) are imported where
+# they are used such that trivial commands start fast.
+import datetime, getpass, hashlib, json, locale, logging
+import re, optparse, os, shutil, socket, stat, subprocess, sys, tempfile, time
+import xml.sax
 
 # Minimal compatibility Python2 / Python3
 PY3 = sys.version_info[0] == 3
@@ -63,16 +65,46 @@ if sys.stdout.isatty():
 else:
     DEFAULT_ENCODING = locale.getpreferredencoding()
 
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on this platform.
+    fcntl = None
+try:
+    from os import scandir as _scandir
+except ImportError:
+    _scandir = None
 try:
     from io import StringIO
 except ImportError:
     from cStringIO import StringIO
 try:
-    from urllib.request import Request, urlopen
-    from urllib.parse import urlparse
+    from urllib.parse import urljoin, urlparse
 except ImportError:
-    from urllib2 import Request, urlopen
-    from urlparse import urlparse
+    from urlparse import urljoin, urlparse
+
+try:
+    from functools import lru_cache as _lru_cache
+except ImportError:
+    def _lru_cache(maxsize=128):
+        # Python2: a bounded memo which is cleared when full.
+        def decorator(func):
+            cache = {}
+            def wrapper(*args):
+                if not args in cache:
+                    if len(cache) >= maxsize:
+                        cache.clear()
+                    cache[args] = func(*args)
+                return cache[args]
+            return wrapper
+        return decorator
+
+def _cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
 
 if PY3:
     def _iteritems(dct, **kw):
@@ -84,6 +116,12 @@ else:
 def _urlparse(location):
     return urlparse(location)
 
+def _getargspec(func):
+    import inspect
+    if hasattr(inspect, 'getfullargspec'):
+        return inspect.getfullargspec(func)
+    return inspect.getargspec(func)
+
 def prompt(message):
     '''If the script is run through a ssh command, the message would not
     appear if passed directly in raw_input.'''
@@ -110,10 +148,35 @@ ERRORS = []
 # When processing a project dependency index file, all project names matching
 # one of the *EXCLUDE_PATS* will be considered non-existant.
 EXCLUDE_PATS = []
+# Maximum number of files *fetch* downloads concurrently over http(s).
+FETCH_JOBS = 4
+# Fetched files shared between workspaces (see *AssetStore*).
+# It is created on first use when the *assetStoreDir* variable is set.
+ASSET_STORE = None
+# When not None, packages are installed from this directory, as created
+# by `dws bundle`, instead of being downloaded.
+BUNDLE_DIR = None
+# Cache of build artifacts shared between workspaces (see *ArtifactCache*).
+# It is created on first use when the *artifactCacheDir* variable is set.
+ARTIFACT_CACHE = None
+# When not None, *MakeStep*s look up this build state database
+# and skip projects whose inputs are unchanged since the last successful make.
+BUILD_STATE = None
+# sha1 of the files in the local cache (see *find_cache*).
+CHECKSUMS = None
+# Version candidates found in headers (see *find_header_versions*).
+HEADER_VERSIONS = None
+# ETag/Last-Modified of files fetched over http(s) (see *find_downloads*).
+DOWNLOADS = None
+# Number of bytes read at the start of a header to find its version.
+HEADER_SCAN_SIZE = 64 * 1024
 # Log commands output
 LOGGER = None
 LOGGER_BUFFER = None
 LOGGER_BUFFERING_COUNT = 0
+# Thread-local prefix of log lines, set when steps run concurrently
+# (see *run_pipelined*).
+LOG_PREFIX = None
 
 # Pattern used to search for logs to report through email.
 LOG_PAT = None
@@ -127,12 +190,28 @@ NO_LOG = False
 NO_VIRTUALENV = False
 # Address to email log reports to.
 MAILTO = []
+# Names returned by *python_version*, keyed by binBuildDir, such that
+# python is only run once per process to find its version.
+PYTHON_VERSIONS = {}
 # When True, *find_lib* will prefer static libraries over dynamic ones if both
 # exist for a specific libname. This should match .LIBPATTERNS in prefix.mk.
 STATIC_LIB_FIRST = True
 # When True, the script runs in batch mode and assumes the default answer
 # for every question where it would have prompted the user for an answer.
 USE_DEFAULT_ANSWER = False
+# When True, *Context.save()* only marks the context dirty. The workspace
+# make fragment is written by *flush_contexts()*, before running
+# a shell command and when the script exits.
+WRITE_BEHIND = False
+
+# Reference to a workspace variable (${name}) inside a variable value.
+VARIABLE_REF_PAT = re.compile(r'(.*)\${(\S+)}(.*)')
+# Set of digits separated by dots and/or underscores (see *version_candidates*)
+# The look-behind prevents retrying a match inside a run of digits.
+VERSION_CANDIDATE_PAT = re.compile(r'(?<![0-9])[0-9]+(?:[_.][0-9]+)+')
+# Defines of a version number in a header (see *HeaderVersionMemo*)
+HEADER_VERSION_PAT = re.compile(
+    r'^[ \t]*#define.*VERSION[ \t]+(\S+)', re.MULTILINE)
 
 # Directories where things get installed
 INSTALL_DIRS = ['bin', 'include', 'lib', 'libexec', 'etc', 'share']
@@ -142,6 +221,15 @@ APT_DISTRIBS = ['Debian', 'Ubuntu']
 DNF_DISTRIBS = ['Fedora', 'CentOS']
 PORT_DISTRIBS = ['Darwin']
 
+# Files looked up, in order, to detect the host distribution.
+HOST_VERSION_PATHS = ['/etc/system-release', '/etc/lsb-release',
+    '/etc/debian_version', '/proc/version', '/etc/os-release']
+# (distribution, codename) detected on the host, once per process.
+HOST_PLATFORM = None
+
+# Master connections shared by ssh and rsync commands (see *ssh_options*).
+SSH_CONTROL = None
+
 # Real uid and gid when the -u,--user and/or -g,--group command
 # line arguments are used.
 USER = None
@@ -185,6 +273,40 @@ class MissingError(Error):
                            + ' '.join(prerequisites), 2, project_name)
 
 
+class Environ(dict):
+    '''Dictionary of workspace variables. Every mutation bumps
+    *Variable.generation* such that values cached by *Context.value()*
+    are invalidated.'''
+
+    def __setitem__(self, key, value):
+        Variable.generation += 1
+        super(Environ, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        Variable.generation += 1
+        super(Environ, self).__delitem__(key)
+
+    def clear(self):
+        Variable.generation += 1
+        super(Environ, self).clear()
+
+    def pop(self, *args):
+        Variable.generation += 1
+        return super(Environ, self).pop(*args)
+
+    def popitem(self):
+        Variable.generation += 1
+        return super(Environ, self).popitem()
+
+    def setdefault(self, key, default=None):
+        Variable.generation += 1
+        return super(Environ, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        Variable.generation += 1
+        super(Environ, self).update(*args, **kwargs)
+
+
 class Context(object):
     '''The workspace configuration file contains environment variables used
     to update, build and package projects. The environment variables are roots
@@ -194,6 +316,9 @@ class Context(object):
     config_name = 'dws.mk'
     indexName = 'dws.xml'
 
+    # Contexts saved while in *WRITE_BEHIND* mode and not yet flushed.
+    pending_saves = set([])
+
     def __init__(self):
         # Two following variables are used by interactively change the make
         # command-line.
@@ -231,9 +356,16 @@ class Context(object):
 '                       control lives on the local machine.',
                'base': 'siteTop',
                'default':'reps'})
-        dist = HostPlatform('-')
-        dist.configure(None)
-        self.environ = {'buildTop': build_top,
+        # Resolved values returned by *value()*, valid as long as
+        # *Variable.generation* is equal to *_value_generation*.
+        self._value_cache = {}
+        self._value_generation = None
+        # Directories returned by *search_path()*, keyed by its arguments
+        # and the environment they are derived from, valid as long as
+        # *Variable.generation* is equal to *_search_paths_generation*.
+        self._search_paths = {}
+        self._search_paths_generation = None
+        self.environ = Environ({'buildTop': build_top,
                         'srcTop' : src_top,
                         'patchTop': Pathname('patchTop',
              {'description':'Root of the tree where patches are stored',
@@ -312,6 +444,33 @@ class Context(object):
 '                       command line option). This is the address that will\n'\
 '                       be shown in the *From* field.',
                'default': runuser() + '@localhost'}),
+                         'artifactCacheDir': Variable('artifactCacheDir',
+             {'description':
+                   'Directory (local or host:path reachable through rsync)\n'\
+'                       where the files installed by make are cached and\n'\
+'                       shared between workspaces. Empty disables the cache.',
+               'value': ''}),
+                         'artifactCacheSize': Variable('artifactCacheSize',
+             {'description':
+                   'Maximum size of *artifactCacheDir* (ex: 500M, 10G)\n'\
+'                       before least recently used artifacts are evicted.',
+               'value': ''}),
+                         'aptListsMaxAge': Variable('aptListsMaxAge',
+             {'description':
+                   'Number of hours after which apt package lists are\n'\
+'                       refreshed (apt-get update) before installing packages.',
+               'value': ''}),
+                         'assetStoreDir': Variable('assetStoreDir',
+             {'description':
+                   'Directory shared by all workspaces on the machine where\n'\
+'                       fetched files are stored by sha1 and linked from\n'\
+'                       (ex: ~/.cache/dws/assets). Empty disables the store.',
+               'value': ''}),
+                         'assetStoreSize': Variable('assetStoreSize',
+             {'description':
+                   'Maximum size of *assetStoreDir* (ex: 500M, 10G)\n'\
+'                       before least recently used files are evicted.',
+               'value': ''}),
        # Variables where modified and original sysconfig files are stored.
                         'modEtcDir': Pathname('modEtcDir',
              {'description':
@@ -322,10 +481,8 @@ class Context(object):
             {'description':
 'directory root that contains the orignal system configuration files.',
              'base':'srcTop',
-             'default': os.path.join(
-                 'share', 'tero', dist.dist_codename if dist.dist_codename
-                 else dist.value)})
-        }
+             'default': self._default_tpl_etc_dir})
+        })
         self.build_top_relative_cwd = None
         self.config_filename = None
 
@@ -468,8 +625,24 @@ class Context(object):
                                 self.value('remoteSiteTop'))
         return None
 
+    def _default_tpl_etc_dir(self):
+        '''Default for *tplEtcDir*, derived from the host platform.
+        It is computed the first time it is needed such that creating
+        a Context does not detect the platform.'''
+        dist = self.environ['distHost']
+        if isinstance(dist, HostPlatform):
+            dist.configure(None)
+            dist_name = dist.dist_codename or dist.value
+        else:
+            detected, codename = detect_host_platform()
+            dist_name = codename if codename and detected == dist else dist
+        return os.path.join('share', 'tero', dist_name or '')
+
     def load_context(self, filename):
         site_top_found = False
+        for context in list(Context.pending_saves):
+            if context.config_filename == filename:
+                context.flush()
         with open(filename) as config_file:
             line = config_file.readline()
             while line != '':
@@ -650,22 +823,81 @@ class Context(object):
             # No config_filename means we are still figuring out siteTop,
             # so we don't know where to store the config file.
             return
-        if not os.path.exists(os.path.dirname(self.config_filename)):
-            os.makedirs(os.path.dirname(self.config_filename))
-        config_file = open(self.config_filename, 'w')
-        keys = sorted(self.environ.keys())
-        config_file.write('# configuration for development workspace\n\n')
-        for key in keys:
-            val = self.environ[key]
-            if str(val):
-                config_file.write(key + '=' + str(val) + '\n')
-        config_file.close()
+        if WRITE_BEHIND:
+            Context.pending_saves.add(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        '''Write the config to a file now. The file is replaced atomically
+        while holding an advisory lock such that parallel dws processes
+        sharing the workspace do not clobber each other. Variables
+        in the file that this context does not know about are preserved.'''
+        Context.pending_saves.discard(self)
+        if not self.config_filename:
+            return
+        dirname = os.path.dirname(self.config_filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.config_filename + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            lines = {}
+            if os.path.isfile(self.config_filename):
+                with open(self.config_filename) as config_file:
+                    for line in config_file.readlines():
+                        look = re.match(r'(\S+)\s*=\s*(\S+)', line)
+                        if look and not look.group(1) in self.environ:
+                            lines[look.group(1)] = line.rstrip('\n')
+            for key, val in _iteritems(self.environ):
+                if str(val):
+                    lines[key] = key + '=' + str(val)
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=dirname,
+                prefix=os.path.basename(self.config_filename))
+            try:
+                with os.fdopen(tmp_fd, 'w') as config_file:
+                    config_file.write(
+                        '# configuration for development workspace\n\n')
+                    for key in sorted(lines.keys()):
+                        config_file.write(lines[key] + '\n')
+                if os.path.exists(self.config_filename):
+                    shutil.copymode(self.config_filename, tmp_path)
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(tmp_path, 0o666 & ~umask)
+                os.rename(tmp_path, self.config_filename)
+            except (IOError, OSError):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
 
     def search_path(self, name, variant=None):
         """
         Derives a list of directory names based on the PATH
         environment variable, *name* and a *variant* triplet.
         """
+        if Variable.generation != self._search_paths_generation:
+            self._search_paths = {}
+            self._search_paths_generation = Variable.generation
+        key = (name, variant, os.environ.get('PATH'), NO_VIRTUALENV)
+        if not key in self._search_paths:
+            dirs = self._derive_search_path(name, variant)
+            if Variable.generation != self._search_paths_generation:
+                # Resolving *name*Dir configured variables. Search paths
+                # derived before then might be stale.
+                self._search_paths = {}
+                self._search_paths_generation = Variable.generation
+            self._search_paths[key] = dirs
+        return list(self._search_paths[key])
+
+    def invalidate_search_paths(self):
+        '''Forgets directories found by *search_path()*, for example
+        after packages were installed or projects were built, which
+        might have created directories.'''
+        self._search_paths = {}
+
+    def _derive_search_path(self, name, variant=None):
         py_ver = python_version(self)
         candidates = []
         # We want the actual value of *name*Dir and not one derived from binDir
@@ -744,6 +976,12 @@ class Context(object):
     def value(self, name):
         '''returns the value of the workspace variable *name*. If the variable
         has no value yet, a prompt is displayed for it.'''
+        generation = Variable.generation
+        if generation != self._value_generation:
+            self._value_cache = {}
+            self._value_generation = generation
+        if name in self._value_cache:
+            return self._value_cache[name]
         if not name in self.environ:
             raise Error("Trying to read unknown variable " + name + ".")
         if (isinstance(self.environ[name], Variable)
@@ -753,7 +991,7 @@ class Context(object):
         # in the variable value. We do this here and not while loading
         # the context because those names can have been defined later.
         value = str(self.environ[name])
-        look = re.match(r'(.*)\${(\S+)}(.*)', value)
+        look = VARIABLE_REF_PAT.match(value)
         while look:
             indirect = ''
             if look.group(2) in self.environ:
@@ -761,7 +999,13 @@ class Context(object):
             elif look.group(2) in os.environ:
                 indirect = os.environ[look.group(2)]
             value = look.group(1) + indirect + look.group(3)
-            look = re.match(r'(.*)\${(\S+)}(.*)', value)
+            look = VARIABLE_REF_PAT.match(value)
+        if Variable.generation != self._value_generation:
+            # Resolving *name* configured variables. Values cached
+            # before then might be stale.
+            self._value_cache = {}
+            self._value_generation = Variable.generation
+        self._value_cache[name] = value
         return value
 
 
@@ -797,6 +1041,8 @@ class IndexProjects(object):
         self.parser = XMLDbParser(context)
 # XXX testing:        self.parser = YAMLikeParser(context)
         self.source = source
+        # (signature, pickled projects) of the index last parsed.
+        self.compiled = None
 
     def closure(self, dgen):
         '''Find out all dependencies from a root set of projects as defined
@@ -808,7 +1054,54 @@ class IndexProjects(object):
     def parse(self, dgen):
         '''Parse the project index and generates callbacks to *dgen*'''
         self.validate()
-        self.parser.parse(self.source, dgen)
+        projects = self.compiled_projects()
+        if projects is None:
+            self.parser.parse(self.source, dgen)
+            return
+        for proj in projects:
+            dgen.project(proj)
+        dgen.end_parse()
+
+    def compiled_projects(self):
+        '''Returns fresh *Project* instances for all projects in the index,
+        or None when the index is not a file.
+
+        The projects are kept pickled, in memory and in *buildTop*, keyed
+        by the absolute path of the index and its signature, such that
+        the index is only parsed again when it changes. Unpickling is
+        faster than parsing the XML and, unlike reusing instances, is safe
+        with handlers that modify the projects they receive.'''
+        import pickle
+        signature = self.signature()
+        if signature is None:
+            return None
+        key = (os.path.abspath(self.source), signature)
+        compiled_path = os.path.join(
+            self.context.value('buildTop'), '.dws-index.compiled')
+        if self.compiled is None or self.compiled[0] != key:
+            self.compiled = None
+            try:
+                with open(compiled_path, 'rb') as compiled_file:
+                    compiled = pickle.load(compiled_file)
+                if compiled[0] == key:
+                    self.compiled = compiled
+            except (IOError, OSError, EOFError, ValueError, TypeError,
+                    IndexError, pickle.UnpicklingError):
+                # A missing or corrupted compiled index is parsed again.
+                pass
+        if self.compiled is None:
+            recorder = IndexRecorder()
+            self.parser.parse(self.source, recorder)
+            self.compiled = (key, pickle.dumps(
+                recorder.projects, pickle.HIGHEST_PROTOCOL))
+            try:
+                with open(compiled_path, 'wb') as compiled_file:
+                    pickle.dump(self.compiled, compiled_file,
+                        pickle.HIGHEST_PROTOCOL)
+            except (IOError, OSError):
+                # We will parse the index in the next run.
+                pass
+        return pickle.loads(self.compiled[1])
 
     def validate(self, force=False):
         '''Create the project index file if it does not exist
@@ -837,10 +1130,28 @@ class IndexProjects(object):
                     vcs = Repository.associate(remote_index)
                     # XXX Does not matter here for rsync.
                     # What about other repos?
+                    # http fetches are conditional, git only pulls when
+                    # the remote head moved and rsync skips files whose
+                    # size and modification time match, so an unchanged
+                    # index keeps its signature, and its compiled projects
+                    # are reused by *parse()*.
+                    signature = self.signature()
                     vcs.update(None, self.context)
+                    if signature and signature == self.signature():
+                        log_info("%s is up-to-date" % self.source,
+                            context=self.context)
             if not os.path.exists(self.source):
                 raise Error(self.source + ' does not exist.')
 
+    def signature(self):
+        '''Returns the (size, mtime, inode) of the project index file
+        or None if it does not exist yet.'''
+        try:
+            stats = os.stat(self.source)
+        except OSError:
+            return None
+        return (stats.st_size, stats.st_mtime, stats.st_ino)
+
 
 class PdbHandler(object):
     '''Callback interface for a project index as generated by an *xmlDbParser*.
@@ -856,6 +1167,17 @@ class PdbHandler(object):
         pass
 
 
+class IndexRecorder(PdbHandler):
+    '''Records the projects in an index, in order.'''
+
+    def __init__(self):
+        PdbHandler.__init__(self)
+        self.projects = []
+
+    def project(self, proj):
+        self.projects += [proj]
+
+
 class Unserializer(PdbHandler):
     '''Builds *Project* instances for every project that matches *include_pats*
     and not *exclude_pats*. See *filters*() for implementation.'''
@@ -884,15 +1206,61 @@ class Unserializer(PdbHandler):
                         project_name=name)
         return self.projects[name]
 
+    @property
+    def include_pats(self):
+        return self._include_pats
+
+    @include_pats.setter
+    def include_pats(self, include_pats):
+        self._include_pats = include_pats
+        self._matcher = None
+
+    @property
+    def exclude_pats(self):
+        return self._exclude_pats
+
+    @exclude_pats.setter
+    def exclude_pats(self, exclude_pats):
+        self._exclude_pats = exclude_pats
+        self._matcher = None
+
+    @staticmethod
+    def _compile_pats(pats):
+        '''Returns the set of *pats* which are plain project names
+        and a single regular expression matching any of *pats*.'''
+        literals = set([])
+        regexes = []
+        for pat in pats:
+            # Many C++ projects contain ++ in their name which might trip
+            # the regular expression parser.
+            pat = pat.replace('+', '\\+')
+            if re.match(r'^[^.^$*?{}\[\]\\|()]*$', pat.replace('\\+', '')):
+                literals |= set([pat.replace('\\+', '+')])
+            regexes += ['(?:%s)' % pat]
+        regex = re.compile('|'.join(regexes)) if regexes else None
+        return literals, regex
+
     def filters(self, project_name):
-        for inc in self.include_pats:
-            inc = inc.replace('+', '\\+')
-            if re.match(inc, project_name):
-                for exc in self.exclude_pats:
-                    if re.match(exc.replace('+', '\\+'), project_name):
-                        return False
-                return True
-        return False
+        matcher = getattr(self, '_matcher', None)
+        if matcher is None:
+            # Patterns are compiled the first time they are needed after
+            # *include_pats* or *exclude_pats* changed.
+            matcher = (self._compile_pats(getattr(self, '_include_pats', [])),
+                       self._compile_pats(self.exclude_pats), {})
+            self._matcher = matcher
+        (inc_literals, inc_regex), (exc_literals, exc_regex), results = matcher
+        if not project_name in results:
+            # As with re.match, patterns match the beginning of names,
+            # so an exact name is a match but a miss must go through
+            # the regular expression.
+            found = (project_name in inc_literals
+                or (inc_regex is not None and inc_regex.match(project_name)))
+            if found:
+                found = not (project_name in exc_literals
+                    or (exc_regex is not None
+                        and exc_regex.match(project_name)))
+            results[project_name] = bool(found)
+        return results[project_name]
 
     def project(self, proj_obj):
         '''Callback for the parser.'''
@@ -1143,6 +1511,17 @@ class DependencyGenerator(Unserializer):
                             packages += [row]
                     else:
                         packages += [row]
+            # Show the version the package manager has for each package,
+            # querying the package manager once for all of them.
+            names = [row[0] for row in packages if len(row) == 1]
+            install_step = create_managed(names[0]) if names else None
+            if install_step:
+                installed, available = install_step.snapshot(names)
+                for row in packages:
+                    if len(row) == 1 and installed.get(row[0]):
+                        row += [installed[row[0]]]
+                    elif len(row) == 1 and available.get(row[0]):
+                        row += ['%s (available)' % available[row[0]]]
             # Prompt to choose amongst installing from repository
             # patch or package when those tags are available.'''
             reps, packages = select_checkout(reps, packages)
@@ -1150,9 +1529,8 @@ class DependencyGenerator(Unserializer):
             self.packages |= set(packages)
         # Add all these in the include_pats such that we load project
         # information the next time around.
-        for name in self.active_prerequisites:
-            if not name in self.include_pats:
-                self.include_pats |= set([name])
+        if not set(self.active_prerequisites) <= self.include_pats:
+            self.include_pats |= set(self.active_prerequisites)
 
     def more(self):
         '''True if there are more iterations to conduct.'''
@@ -1387,24 +1765,75 @@ class MakeGenerator(DependencyGenerator):
         return results
 
 
-class DerivedSetsGenerator(PdbHandler):
-    '''Generate the set of projects which are not dependency
-    for any other project.'''
+class ProjectGraph(PdbHandler):
+    '''Dependency graph of the projects in the index, with forward
+    (project to prerequisites) and reverse (project to dependents)
+    adjacency sets.'''
 
     def __init__(self):
         PdbHandler.__init__(self)
-        self.roots = []
-        self.nonroots = []
+        # Project names in the order they were encountered.
+        self.names = []
+        self.forward = {}
+        self.reverse = {}
+        self._roots = None
 
     def project(self, proj):
+        if not proj.name in self.forward:
+            self.names += [proj.name]
+            self.forward[proj.name] = set([])
         for dep_name in proj.prerequisite_names([CONTEXT.host()]):
-            if dep_name in self.roots:
-                self.roots.remove(dep_name)
-            if not dep_name in self.nonroots:
-                self.nonroots += [dep_name]
-        if (not proj.name in self.nonroots
-            and not proj.name in self.roots):
-            self.roots += [proj.name]
+            self.forward[proj.name] |= set([dep_name])
+            self.reverse.setdefault(dep_name, set([])).add(proj.name)
+        self._roots = None
+
+    @property
+    def roots(self):
+        '''Projects which are not a prerequisite of any other project.'''
+        if self._roots is None:
+            self._roots = [name for name in self.names
+                           if not self.reverse.get(name)]
+        return self._roots
+
+    @property
+    def leaves(self):
+        '''Projects (or prerequisites not defined in the index)
+        which have no prerequisites.'''
+        leaves = [name for name in self.names if not self.forward[name]]
+        for name in self.names:
+            for dep_name in sorted(self.forward[name]):
+                if not dep_name in self.forward and not dep_name in leaves:
+                    leaves += [dep_name]
+        return leaves
+
+    @staticmethod
+    def _closure(adjacency, name):
+        visited = set([])
+        pending = list(adjacency.get(name, []))
+        while len(pending) > 0:
+            current = pending.pop()
+            if not current in visited:
+                visited |= set([current])
+                pending += list(adjacency.get(current, []))
+        return visited
+
+    def prerequisites(self, name):
+        '''Returns the set of projects *name* transitively depends on.'''
+        return self._closure(self.forward, name)
+
+    def dependents(self, name):
+        '''Returns the set of projects which transitively depend
+        on *name*, i.e. what needs to be rebuilt when *name* changes.'''
+        return self._closure(self.reverse, name)
+
+
+class DerivedSetsGenerator(ProjectGraph):
+    '''Generate the set of projects which are not dependency
+    for any other project.'''
+
+    @property
+    def nonroots(self):
+        return list(self.reverse.keys())
 
 # =============================================================================
 #     Writers are used to save *Project* instances to persistent storage
@@ -1422,6 +1851,19 @@ class Variable(object):
     '''Variable that ends up being defined in the workspace make
     fragment and thus in Makefile.'''
 
+    # Incremented every time a variable or a context *environ* changes
+    # such that resolved values can be cached in between.
+    generation = 0
+
+    def __setattr__(self, name, value):
+        if name in ('value', 'default', 'base'):
+            # Lists are compared by value but might be mutated in place
+            # later on so we always consider them a change.
+            if (isinstance(value, list)
+                or getattr(self, name, None) != value):
+                Variable.generation += 1
+        super(Variable, self).__setattr__(name, value)
+
     def __init__(self, name, pairs):
         self.name = name
         self.value = None
@@ -1484,49 +1926,72 @@ class HostPlatform(Variable):
         Initialize an HostPlatform variable. *pairs* is a dictionnary.
         """
         Variable.__init__(self, name, pairs)
-        self.dist_codename = None
+        self._dist_codename = None
+
+    @property
+    def dist_codename(self):
+        # When the distribution was read from the workspace make fragment,
+        # we only trust the detected codename if the detected distribution
+        # is the same.
+        if self._dist_codename is None and self.value:
+            dist, codename = detect_host_platform()
+            if dist == self.value:
+                self._dist_codename = codename
+        return self._dist_codename
+
+    @dist_codename.setter
+    def dist_codename(self, codename):
+        self._dist_codename = codename
 
     def configure(self, context):
         '''Set value to the distribution on which the script is running.'''
         if self.value != None:
             return False
-        # sysname, nodename, release, version, machine
-        sysname, _, _, version, _ = os.uname()
-        if sysname == 'Darwin':
-            self.value = 'Darwin'
-        elif sysname == 'Linux':
-            # Let's try to determine the host platform
-            for version_path in ['/etc/system-release', '/etc/lsb-release',
-                                 '/etc/debian_version', '/proc/version']:
-                if os.path.exists(version_path):
-                    version = open(version_path)
-                    line = version.readline()
-                    while line != '':
-                        for dist in APT_DISTRIBS + DNF_DISTRIBS:
-                            look = re.match('.*' + dist + '.*', line)
-                            if look:
-                                self.value = dist
-                            look = re.match('.*' + dist.lower() + '.*', line)
+        self.value, self.dist_codename = detect_host_platform()
+        return True
+
+
+def detect_host_platform():
+    '''Returns the distribution and codename of the host. The host is only
+    inspected the first time this function is called in the process.'''
+    global HOST_PLATFORM
+    if HOST_PLATFORM is not None:
+        return HOST_PLATFORM
+    value = None
+    dist_codename = None
+    # sysname, nodename, release, version, machine
+    sysname, _, _, version, _ = os.uname()
+    if sysname == 'Darwin':
+        value = 'Darwin'
+    elif sysname == 'Linux':
+        dist_pats = [(dist, re.compile('.*(%s|%s).*' % (dist, dist.lower())))
+                     for dist in APT_DISTRIBS + DNF_DISTRIBS]
+        codename_pat = re.compile(
+            r'(?:DISTRIB_CODENAME|VERSION_CODENAME)=\s*(\S+)')
+        release_pat = re.compile(r'.*release (\d+)')
+        # Let's try to determine the host platform
+        for version_path in HOST_VERSION_PATHS:
+            if os.path.exists(version_path):
+                with open(version_path) as version:
+                    for line in version.readlines():
+                        for dist, dist_pat in dist_pats:
+                            if dist_pat.match(line):
+                                value = dist
+                        if not dist_codename:
+                            look = codename_pat.match(line)
                             if look:
-                                self.value = dist
-                            if not self.dist_codename:
-                                look = re.match(
-                                    r'DISTRIB_CODENAME=\s*(\S+)', line)
+                                dist_codename = look.group(1)
+                            elif value:
+                                # First time around the loop we will
+                                # match this pattern but not the previous
+                                # one that sets value to 'Fedora'.
+                                look = release_pat.match(line)
                                 if look:
-                                    self.dist_codename = look.group(1)
-                                elif self.value:
-                                    # First time around the loop we will
-                                    # match this pattern but not the previous
-                                    # one that sets value to 'Fedora'.
-                                    look = re.match(r'.*release (\d+)', line)
-                                    if look:
-                                        self.dist_codename = \
-                                            self.value + look.group(1)
-                        line = version.readline()
-                    version.close()
-                    if self.value:
-                        break
-        return True
+                                    dist_codename = value + look.group(1)
+                if value:
+                    break
+    HOST_PLATFORM = (value, dist_codename)
+    return HOST_PLATFORM
 
 
 class Pathname(Variable):
@@ -1544,6 +2009,11 @@ class Pathname(Variable):
         """
         if self.value != None:
             return False
+        # The default might depend on other variables and thus
+        # be computed on demand.
+        leaf_default = self.default
+        if callable(leaf_default):
+            leaf_default = leaf_default()
         # compute the default leaf directory from the variable name
         leaf_dir = self.name
         for last in range(0, len(self.name)):
@@ -1553,7 +2023,7 @@ class Pathname(Variable):
         dirname = self
         base_value = None
         off_base_chosen = False
-        default = self.default
+        default = leaf_default
         # We buffer the text and delay writing to log because we can get
         # here to find out where the log resides!
         if self.name == 'logDir':
@@ -1598,8 +2068,8 @@ class Pathname(Variable):
         dirname = default
         if off_base_chosen:
             base_value = str(context.environ[self.base])
-            if self.default:
-                dirname = os.path.join(base_value, self.default)
+            if leaf_default:
+                dirname = os.path.join(base_value, leaf_default)
             else:
                 dirname = os.path.join(base_value, leaf_dir)
         else:
@@ -1805,6 +2275,625 @@ class Maintainer(object):
         return self.fullname + ' <' + self.email + '>'
 
 
+class StateStore(object):
+    '''Dictionary persisted as a JSON file. The file is read on first
+    access and written back atomically (through a temporary file renamed
+    over the previous one) so a build interrupted midway never leaves
+    a corrupted store behind.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._state = None
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = {}
+            if os.path.isfile(self.filename):
+                try:
+                    with open(self.filename) as state_file:
+                        self._state = json.load(state_file)
+                except (IOError, OSError, ValueError):
+                    # A corrupted store is as good as an empty one.
+                    self._state = {}
+        return self._state
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        self.state[key] = value
+
+    def remove(self, key):
+        self.state.pop(key, None)
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=dirname, prefix=os.path.basename(self.filename))
+        try:
+            with os.fdopen(tmp_fd, 'w') as state_file:
+                json.dump(self.state, state_file, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.filename)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class ChecksumMemo(StateStore):
+    '''Remembers the sha1 of files such that a file is only hashed again
+    after its size, modification time or inode changed.'''
+
+    def __init__(self, filename):
+        import threading
+        super(ChecksumMemo, self).__init__(filename)
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def sha1(self, pathname):
+        stats = os.stat(pathname)
+        signature = [stats.st_size, stats.st_mtime, stats.st_ino]
+        with self.lock:
+            entry = self.get(pathname)
+        if entry and entry['signature'] == signature:
+            return entry['sha1']
+        sha1sum = _sha1sum(pathname)
+        with self.lock:
+            self.set(pathname, {'signature': signature, 'sha1': sha1sum})
+            self.dirty = True
+        return sha1sum
+
+    def save(self):
+        with self.lock:
+            for pathname in list(self.state.keys()):
+                if not os.path.exists(pathname):
+                    self.remove(pathname)
+            super(ChecksumMemo, self).save()
+            self.dirty = False
+
+
+class HeaderVersionMemo(StateStore):
+    '''Remembers the version candidates defined in headers such that
+    a header is only read again after its size or modification time
+    changed.'''
+
+    def __init__(self, filename):
+        super(HeaderVersionMemo, self).__init__(filename)
+        self.dirty = False
+
+    def versions(self, pathname):
+        '''Returns the version candidates from "#define .*VERSION" lines
+        in the first *HEADER_SCAN_SIZE* bytes of header *pathname*.'''
+        stats = os.stat(pathname)
+        signature = [stats.st_size, stats.st_mtime]
+        entry = self.get(pathname)
+        if entry and entry['signature'] == signature:
+            return entry['versions']
+        with open(pathname, 'rb') as header_file:
+            text = header_file.read(HEADER_SCAN_SIZE).decode(
+                DEFAULT_ENCODING, 'replace')
+        numbers = []
+        for look in HEADER_VERSION_PAT.finditer(text):
+            for ver in version_candidates(look.group(1)):
+                if not ver in numbers:
+                    numbers += [ver]
+        self.set(pathname, {'signature': signature, 'versions': numbers})
+        self.dirty = True
+        return numbers
+
+    def save(self):
+        for pathname in list(self.state.keys()):
+            if not os.path.exists(pathname):
+                self.remove(pathname)
+        super(HeaderVersionMemo, self).save()
+        self.dirty = False
+
+
+class DownloadMemo(StateStore):
+    '''Remembers the ETag and Last-Modified headers the server returned
+    for files downloaded over http(s), and for partial downloads,
+    such that the next request for a file can be conditional.'''
+
+    def __init__(self, filename):
+        import threading
+        super(DownloadMemo, self).__init__(filename)
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def validators(self, pathname):
+        with self.lock:
+            return self.get(pathname, {})
+
+    def record(self, pathname, resp):
+        '''Records the validators in the headers of *resp* for *pathname*.'''
+        validators = {}
+        for header in ('ETag', 'Last-Modified'):
+            if resp.getheader(header):
+                validators[header.lower()] = resp.getheader(header)
+        with self.lock:
+            if validators:
+                self.set(pathname, validators)
+            else:
+                self.remove(pathname)
+            self.dirty = True
+
+    def forget(self, pathname):
+        with self.lock:
+            self.remove(pathname)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            for pathname in list(self.state.keys()):
+                if not os.path.exists(pathname):
+                    self.remove(pathname)
+            super(DownloadMemo, self).save()
+            self.dirty = False
+
+
+class BuildState(StateStore):
+    '''Records the inputs of each *BuildStep* that ran to completion
+    such that a later make with identical inputs can be skipped.
+
+    The fingerprint of a step combines the tree hash of the project
+    sources, the workspace variables and make command line, and
+    the fingerprints of the build steps it depends on.'''
+
+    @staticmethod
+    def source_hash(src_dir):
+        '''Returns the git tree hash of *src_dir* or None when it cannot
+        be trusted to represent the sources (not a git repository,
+        local modifications, etc.).'''
+        if not os.path.isdir(os.path.join(src_dir, '.git')):
+            return None
+        try:
+            with open(os.devnull, 'w') as devnull:
+                status = subprocess.check_output(
+                    ['git', 'status', '--porcelain'],
+                    cwd=src_dir, stderr=devnull)
+                if status.strip():
+                    return None
+                return subprocess.check_output(
+                    ['git', 'rev-parse', 'HEAD^{tree}'],
+                    cwd=src_dir, stderr=devnull).decode(
+                        DEFAULT_ENCODING).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def prerequisite_stamps(self, step):
+        '''Returns the fingerprints of the build steps *step* depends on
+        and the prerequisites resolved by setup steps, looking through
+        intermediate (install, update, etc.) steps, or None if one of them
+        could not be fingerprinted.'''
+        stamps = {}
+        visited = set([])
+        pending = list(step.prerequisites)
+        while len(pending) > 0:
+            prereq = pending.pop()
+            if prereq.name in visited:
+                continue
+            visited |= set([prereq.name])
+            if isinstance(prereq, BuildStep):
+                # Only fingerprints of successful makes are recorded, so
+                # a prerequisite that failed on this run will force
+                # a rebuild on the next one.
+                entry = self.get(prereq.name)
+                if entry is None:
+                    return None
+                stamps[prereq.name] = entry['fingerprint']
+            else:
+                if isinstance(prereq, SetupStep):
+                    # Setup steps run on every build. What matters is
+                    # the files (and thus versions) they resolved.
+                    stamps[prereq.name] = prereq.managed
+                if prereq.updated and (isinstance(prereq, InstallStep)
+                    or not isinstance(prereq, SetupStep)):
+                    # Packages were installed or sources updated
+                    # on this run.
+                    return None
+                pending += prereq.prerequisites
+        return stamps
+
+    def fingerprint(self, step, context):
+        '''Returns the fingerprint of *step* built in *context* or None
+        if the step must run unconditionally.'''
+        tree = self.source_hash(context.src_dir(step.project))
+        stamps = self.prerequisite_stamps(step)
+        fingerprint = None
+        if tree is not None and stamps is not None:
+            variables = {}
+            for key, val in _iteritems(context.environ):
+                if key != 'buildstamp':
+                    variables[key] = str(val)
+            fingerprint = hashlib.sha1(json.dumps({
+                'tree': tree,
+                'variables': variables,
+                'targets': context.targets,
+                'overrides': context.overrides,
+                'prerequisites': stamps},
+                sort_keys=True).encode('utf-8')).hexdigest()
+        return fingerprint
+
+    def is_uptodate(self, step, fingerprint):
+        entry = self.get(step.name)
+        return (fingerprint is not None and entry is not None
+                and entry.get('fingerprint') == fingerprint)
+
+    def record(self, step, fingerprint):
+        if fingerprint is None:
+            self.remove(step.name)
+        else:
+            self.set(step.name, {'fingerprint': fingerprint,
+                'built': datetime.datetime.now().isoformat()})
+        self.save()
+
+
+class ArtifactCache(object):
+    '''Content-addressed cache of the files a *MakeStep* installs
+    into *installTop*.
+
+    Artifacts are compressed tarballs keyed by the project, the make
+    targets and overrides, the host distribution, the git tree hash
+    of the sources, the keys of the prerequisite build steps and
+    the prerequisites resolved by setup and install steps. The cache
+    directory is either local or a *host:path* reached through rsync,
+    in which case *staging_dir* keeps a local copy of the artifacts used.
+    Least recently used artifacts are evicted when the cache grows beyond
+    *max_size*. A remote cache is never evicted by dws, only its local
+    *staging_dir*; it must be pruned on the remote host.'''
+
+    default_size = '10G'
+
+    def __init__(self, cache_dir, staging_dir, max_size=None):
+        self.remote = None
+        look = re.match(r'^(\S+@)?([^/:]+):(.*)$', cache_dir)
+        if look and not os.path.exists(cache_dir):
+            self.remote = (look.group(1)[:-1] if look.group(1) else None,
+                look.group(2), look.group(3))
+            self.cache_dir = staging_dir
+        else:
+            self.cache_dir = cache_dir
+        self.max_size = self.parse_size(max_size or self.default_size)
+        # Keys computed during this run, by step name.
+        self.keys = {}
+
+    @staticmethod
+    def parse_size(size):
+        look = re.match(r'^\s*(\d+)\s*([kKmMgGtT]?)', str(size))
+        if not look:
+            raise Error("cannot interpret '%s' as a size" % size)
+        return int(look.group(1)) * 1024 ** (
+            ' kmgt'.index(look.group(2).lower() or ' '))
+
+    def key(self, step, context):
+        '''Returns the key for the artifact produced by *step* built
+        in *context* or None if the step cannot be cached.'''
+        key = None
+        tree = BuildState.source_hash(context.src_dir(step.project))
+        prerequisites = {}
+        visited = set([])
+        pending = list(step.prerequisites)
+        while tree is not None and len(pending) > 0:
+            prereq = pending.pop()
+            if prereq.name in visited:
+                continue
+            visited |= set([prereq.name])
+            if isinstance(prereq, BuildStep):
+                prerequisites[prereq.name] = self.keys.get(prereq.name)
+                if prerequisites[prereq.name] is None:
+                    tree = None
+            else:
+                if isinstance(prereq, SetupStep):
+                    prerequisites[prereq.name] = {'files': self.resolved_files(
+                        prereq, context.value('installTop'))}
+                    if isinstance(prereq, InstallStep):
+                        prerequisites[prereq.name]['installed'] = \
+                            prereq.installed_versions()
+                else:
+                    prerequisites[prereq.name] = True
+                pending += prereq.prerequisites
+        if tree is not None:
+            dist = CONTEXT.environ['distHost']
+            key = hashlib.sha1(json.dumps({
+                'project': step.project,
+                'target': step.target,
+                'targets': context.targets,
+                'overrides': context.overrides,
+                'distHost': CONTEXT.value('distHost'),
+                'distCodename': getattr(dist, 'dist_codename', None),
+                'tree': tree,
+                'prerequisites': prerequisites},
+                sort_keys=True).encode('utf-8')).hexdigest()
+        self.keys[step.name] = key
+        return key
+
+    @staticmethod
+    def resolved_files(step, install_top):
+        '''Returns the files resolved by setup *step*, relative
+        to *install_top* when installed there, such that the same
+        prerequisites give the same key in every workspace.'''
+        files = {}
+        for dep_name, dep_items in _iteritems(step.managed):
+            files[dep_name] = {}
+            for dirname, prereqs in _iteritems(dep_items['files']):
+                files[dep_name][dirname] = [(name_pat,
+                    absolute_path.replace(install_top, '${installTop}')
+                    if absolute_path else absolute_path)
+                    for name_pat, absolute_path in prereqs]
+        return files
+
+    def pathname(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.tar.gz')
+
+    def _rsync(self, source, dest):
+        username, host, _ = self.remote
+        cmdline, _ = find_rsync(host, relative=False, username=username)
+        try:
+            shell_command(cmdline + [source, dest])
+        except Error:
+            return False
+        return True
+
+    @staticmethod
+    def snapshot(install_top):
+        '''Returns the (mtime, size) of every file under *install_top*.'''
+        files = {}
+        for dirpath, _, filenames in os.walk(install_top):
+            for filename in filenames:
+                pathname = os.path.join(dirpath, filename)
+                try:
+                    stats = os.lstat(pathname)
+                except OSError:
+                    continue
+                files[os.path.relpath(pathname, install_top)] = (
+                    stats.st_mtime, stats.st_size)
+        return files
+
+    def restore(self, key, install_top):
+        '''Extracts the artifact *key* into *install_top*. Returns False
+        if the artifact is not in the cache.'''
+        import tarfile
+        pathname = self.pathname(key)
+        if not os.path.exists(pathname) and self.remote:
+            username, host, remote_dir = self.remote
+            if not os.path.exists(os.path.dirname(pathname)):
+                os.makedirs(os.path.dirname(pathname))
+            self._rsync('%s%s:%s' % (username + '@' if username else '',
+                host, os.path.join(remote_dir, key[:2], key + '.tar.gz')),
+                pathname)
+        if not os.path.exists(pathname):
+            return False
+        try:
+            with tarfile.open(pathname, 'r:gz') as artifact:
+                if hasattr(tarfile, 'tar_filter'):
+                    artifact.extractall(install_top, filter='tar')
+                else:
+                    artifact.extractall(install_top)
+        except (tarfile.TarError, IOError, OSError) as err:
+            log_error("cannot restore artifact %s: %s" % (pathname, err))
+            return False
+        # Mark the artifact as recently used.
+        os.utime(pathname, None)
+        return True
+
+    def store(self, key, install_top, before):
+        '''Stores the files under *install_top* that were added or changed
+        since the *before* snapshot as artifact *key*.'''
+        import tarfile
+        after = self.snapshot(install_top)
+        changed = sorted([name for name, stats in _iteritems(after)
+                          if before.get(name) != stats])
+        pathname = self.pathname(key)
+        if not os.path.exists(os.path.dirname(pathname)):
+            os.makedirs(os.path.dirname(pathname))
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(pathname), suffix='.part')
+        os.close(tmp_fd)
+        try:
+            with tarfile.open(tmp_path, 'w:gz') as artifact:
+                for name in changed:
+                    artifact.add(os.path.join(install_top, name),
+                        arcname=name, recursive=False)
+            os.rename(tmp_path, pathname)
+        except (tarfile.TarError, IOError, OSError) as err:
+            log_error("cannot store artifact %s: %s" % (pathname, err))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        if self.remote:
+            username, host, remote_dir = self.remote
+            # Relative rsync recreates the key[:2] directory on the remote.
+            cmdline, _ = find_rsync(host, relative=True, username=username)
+            try:
+                shell_command(cmdline + [
+                    os.path.join(self.cache_dir, '.', key[:2],
+                                 key + '.tar.gz'),
+                    '%s%s:%s' % (username + '@' if username else '',
+                                 host, remote_dir)])
+            except Error as err:
+                log_error("cannot upload artifact %s: %s" % (pathname, err))
+        self.evict()
+        return True
+
+    def evict(self, max_size=None):
+        '''Removes least recently used artifacts until the cache
+        is smaller than *max_size*. Returns the number of bytes freed.
+        With a remote cache, only the local staging directory is evicted.'''
+        if max_size is None:
+            max_size = self.max_size
+        artifacts = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.tar.gz'):
+                    pathname = os.path.join(dirpath, filename)
+                    stats = os.stat(pathname)
+                    artifacts += [(stats.st_mtime, stats.st_size, pathname)]
+                    total += stats.st_size
+        freed = 0
+        for _, size, pathname in sorted(artifacts):
+            if total - freed <= max_size:
+                break
+            os.remove(pathname)
+            freed += size
+        return freed
+
+
+def find_artifact_cache():
+    '''Returns the artifact cache configured for the workspace or None.'''
+    global ARTIFACT_CACHE
+    if ARTIFACT_CACHE is None and CONTEXT is not None:
+        cache_dir = CONTEXT.value('artifactCacheDir')
+        if cache_dir:
+            ARTIFACT_CACHE = ArtifactCache(cache_dir,
+                os.path.join(CONTEXT.value('buildTop'), '.dws-artifacts'),
+                CONTEXT.value('artifactCacheSize'))
+    return ARTIFACT_CACHE
+
+
+class AssetStore(object):
+    '''Content-addressed store of the files *fetch* downloads, shared
+    between all workspaces on a machine.
+
+    Files are stored by sha1 and hardlinked (or copied when *store_dir*
+    is on another filesystem) into the *siteTop* of each workspace
+    that needs them. The time a file was last linked is recorded
+    in *store_dir*/last_used.json such that least recently used files
+    are evicted when the store grows beyond *max_size*.'''
+
+    default_size = '20G'
+
+    def __init__(self, store_dir, max_size=None):
+        self.store_dir = store_dir
+        self.max_size = ArtifactCache.parse_size(
+            max_size or self.default_size)
+        self.last_used = StateStore(os.path.join(store_dir, 'last_used.json'))
+        # Files used during this run, by sha1, not yet in *last_used*.
+        self.touched = {}
+
+    def pathname(self, sha1):
+        return os.path.join(self.store_dir, sha1[:2], sha1)
+
+    def has(self, sha1):
+        return os.path.isfile(self.pathname(sha1))
+
+    @staticmethod
+    def _link(source, dest):
+        '''Hardlinks *source* to *dest*, falling back to a copy,
+        and atomically replaces *dest* if it exists.'''
+        dirname = os.path.dirname(dest)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.part')
+        os.close(tmp_fd)
+        os.remove(tmp_path)
+        try:
+            try:
+                os.link(source, tmp_path)
+            except (AttributeError, OSError):
+                shutil.copy2(source, tmp_path)
+            os.rename(tmp_path, dest)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def touch(self, sha1):
+        '''Marks *sha1* as used. The time is only written by *save()*.'''
+        self.touched[sha1] = time.time()
+
+    def save(self):
+        '''Records the files used since the last save in last_used.json
+        and evicts least recently used files if the store grew too large.
+        The store is locked while doing so because other workspaces
+        might be updating it at the same time.'''
+        if not self.touched:
+            return
+        try:
+            with open(self.last_used.filename + '.lock', 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                # Merge with the times recorded by other workspaces.
+                self.last_used = StateStore(self.last_used.filename)
+                for sha1, used in _iteritems(self.touched):
+                    if used > self.last_used.get(sha1, 0):
+                        self.last_used.set(sha1, used)
+                self.last_used.save()
+                self.evict()
+        except (IOError, OSError):
+            # Another user might own the store. It only costs
+            # a less accurate eviction order.
+            pass
+        self.touched = {}
+
+    def link(self, sha1, dest):
+        '''Links the file with checksum *sha1* to *dest*. Returns False
+        if it is not in the store.'''
+        if not self.has(sha1):
+            return False
+        try:
+            self._link(self.pathname(sha1), dest)
+        except (IOError, OSError) as err:
+            log_error("cannot link %s from the asset store: %s" % (dest, err))
+            return False
+        self.touch(sha1)
+        return True
+
+    def add(self, sha1, pathname):
+        '''Adds *pathname*, whose checksum is *sha1*, to the store.'''
+        if self.has(sha1):
+            return
+        try:
+            self._link(pathname, self.pathname(sha1))
+        except (IOError, OSError) as err:
+            log_error("cannot add %s to the asset store: %s" % (pathname, err))
+            return
+        self.touch(sha1)
+
+    def evict(self, max_size=None):
+        '''Removes least recently used files until the store
+        is smaller than *max_size*. Returns the number of bytes freed.'''
+        if max_size is None:
+            max_size = self.max_size
+        assets = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.store_dir):
+            if dirpath == self.store_dir:
+                continue
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                pathname = os.path.join(dirpath, filename)
+                stats = os.stat(pathname)
+                assets += [(self.last_used.get(filename, stats.st_mtime),
+                            stats.st_size, filename, pathname)]
+                total += stats.st_size
+        freed = 0
+        for _, size, sha1, pathname in sorted(assets):
+            if total - freed <= max_size:
+                break
+            os.remove(pathname)
+            self.last_used.remove(sha1)
+            freed += size
+        if freed:
+            self.last_used.save()
+        return freed
+
+
+def find_asset_store():
+    '''Returns the asset store configured for the workspace or None.'''
+    global ASSET_STORE
+    if ASSET_STORE is None and CONTEXT is not None:
+        store_dir = CONTEXT.value('assetStoreDir')
+        if store_dir:
+            ASSET_STORE = AssetStore(store_dir,
+                CONTEXT.value('assetStoreSize'))
+    return ASSET_STORE
+
+
 class Step(object):
     '''Step in the build DAG.'''
 
@@ -1969,6 +3058,11 @@ class InstallStep(SetupStep):
     to actually install through the native package manager. (see: ``run``)
     This works in concert with the ``DependencyGenerator.add_install`` method.
     """
+
+    # (queried, installed, available) per package manager, shared by all
+    # instances such that each manager is queried once for all packages.
+    snapshots = {}
+
     def __init__(self, project_name, alt_names=None,
                  versions=None, target=None):
         super(InstallStep, self).__init__(project_name, {},
@@ -1996,6 +3090,8 @@ class InstallStep(SetupStep):
     def run(self, context):
         super(InstallStep, self).run(context)
         self.updated = False
+        if self.incompletes:
+            self.incompletes = self.unsatisfied(self.incompletes)
         installs = self.get_installs()
         if len(installs) > 0:
             self.install(installs, context)
@@ -2005,15 +3101,108 @@ class InstallStep(SetupStep):
         raise Error("Does not know how to install '%s' on %s for %s"
                     % (managed, context.host(), self.name))
 
+    def bundle_commands(self, managed, bundle_dir):
+        '''Returns the commands that download the packages in *managed*,
+        and the packages they depend on, into *bundle_dir*.'''
+        return []
+
     def install(self, managed, context):
         for cmdline, admin, noexecute in self.install_commands(
                 managed, context):
             shell_command(cmdline, admin=admin, noexecute=noexecute)
+        self.invalidate_snapshot()
 
-    def info(self):
+    @classmethod
+    def query(cls, names):
+        '''Returns a tuple (installed, available) of dictionnaries mapping
+        package names to their version as reported by the package manager
+        in a single invocation. The version is None when it is unknown.'''
         raise Error(
-            "Does not know how to search package manager for '%s' on %s for %s"
-            % (str(self.managed), CONTEXT.host(), self.name))
+            "Does not know how to search package manager for '%s' on %s"
+            % (' '.join(names), CONTEXT.host()))
+
+    @staticmethod
+    def _query_output(cmdline):
+        try:
+            return subprocess.check_output(cmdline,
+                stderr=subprocess.PIPE).decode(DEFAULT_ENCODING)
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+
+    @classmethod
+    def snapshot(cls, names):
+        '''Returns a tuple (installed, available) of dictionnaries mapping
+        package names to versions. The package manager is only queried
+        for the names which are not already in the snapshot.'''
+        queried, installed, available = cls.snapshots.setdefault(
+            cls.__name__, (set([]), {}, {}))
+        missing = [name for name in names if not name in queried]
+        if missing:
+            more_installed, more_available = cls.query(missing)
+            installed.update(more_installed)
+            available.update(more_available)
+            queried |= set(missing)
+        return installed, available
+
+    @classmethod
+    def invalidate_snapshot(cls):
+        cls.snapshots.pop(cls.__name__, None)
+        # Installed packages might have created new search directories.
+        if CONTEXT:
+            CONTEXT.invalidate_search_paths()
+
+    def unsatisfied(self, dep_names):
+        '''Returns the projects in *dep_names* for which the package manager
+        does not already have a package installed in an acceptable
+        version.'''
+        names = []
+        for dep_name in dep_names:
+            names += self.alt_names.get(dep_name, [dep_name])
+        try:
+            installed, _ = self.snapshot(names)
+        except Error:
+            # We do not know how to query this package manager.
+            return dep_names
+        results = []
+        for dep_name in dep_names:
+            satisfied = True
+            for name in self.alt_names.get(dep_name, [dep_name]):
+                if not (name in installed and version_satisfies(
+                        installed[name], self.managed[dep_name])):
+                    satisfied = False
+                    break
+            if satisfied:
+                log_info("%s already installed" % dep_name)
+            else:
+                results += [dep_name]
+        return results
+
+    def installed_versions(self):
+        '''Returns a dictionnary of the versions installed for all packages
+        managed by this step, or None if the package manager cannot
+        be queried.'''
+        names = []
+        for dep_name in self.managed:
+            names += self.alt_names.get(dep_name, [dep_name])
+        try:
+            installed, _ = self.snapshot(names)
+        except Error:
+            return None
+        return dict([(name, installed.get(name)) for name in names])
+
+    def info(self):
+        '''Returns a tuple (info, unmanaged) of the packages the package
+        manager knows about and the ones it does not.'''
+        names = self.get_installs()
+        installed, available = self.snapshot(names)
+        info = []
+        unmanaged = []
+        for name in names:
+            if name in installed or name in available:
+                info += [name]
+            else:
+                unmanaged += [name]
+        return info, unmanaged
 
 
 class AptInstallStep(InstallStep):
@@ -2025,8 +3214,24 @@ class AptInstallStep(InstallStep):
             versions=versions, target=target)
         self.priority = Step.install_native
 
+    # Directories apt-get update writes into.
+    lists_dirs = ['/var/lib/apt/lists', '/var/lib/apt/lists/partial']
+    default_lists_max_age = 24
+
+    @classmethod
+    def lists_outdated(cls, context):
+        '''Returns True when the package lists were last updated longer
+        than *aptListsMaxAge* hours ago.'''
+        max_age = context.value('aptListsMaxAge')
+        max_age = float(max_age) if max_age else cls.default_lists_max_age
+        updated_at = 0
+        for dirname in cls.lists_dirs:
+            if os.path.isdir(dirname):
+                updated_at = max(updated_at, os.stat(dirname).st_mtime)
+        return time.time() - updated_at > max_age * 3600
+
     @staticmethod
-    def install_commands(managed, context):
+    def install_commands(managed, context, update=True):
         # Add DEBIAN_FRONTEND=noninteractive such that interactive
         # configuration of packages do not pop up in the middle
         # of installation. We are going to update the configuration
@@ -2034,32 +3239,102 @@ class AptInstallStep(InstallStep):
         # Emit only one shell command so that we can find out what the script
         # tried to do when we did not get priviledge access.
         admin = True
-        return [(['sh', '-c', '"/usr/bin/apt-get update'\
-' && DEBIAN_FRONTEND=noninteractive /usr/bin/apt-get -y install %s"'
-                       % ' '.join(managed)], admin, context.nonative)]
+        if BUNDLE_DIR:
+            debs = AptInstallStep.bundle_debs(managed)
+            if not debs:
+                return []
+            return [(['DEBIAN_FRONTEND=noninteractive', '/usr/bin/apt-get',
+                '-y', '--no-download', 'install'] + debs,
+                admin, context.nonative)]
+        # The script is a single argument, double-quoted by *shell_cmdline*.
+        return [(['sh', '-c', '%sDEBIAN_FRONTEND=noninteractive'\
+' /usr/bin/apt-get -y install %s'
+                       % ('/usr/bin/apt-get update && ' if update else '',
+                          ' '.join(managed))], admin, context.nonative)]
 
-    def info(self):
-        info = []
-        unmanaged = []
-        try:
-            # apt-cache showpkg will return 0 even when the package cannot
-            # be found.
-            cmdline = ['apt-cache', 'showpkg'] + self.managed
-            manager_output = subprocess.check_output(' '.join(cmdline),
-                shell=True, stderr=subprocess.STDOUT).decode(DEFAULT_ENCODING)
-            found = False
-            for line in manager_output.splitlines():
-                if re.match('^Package:', line):
-                    # Apparently we are not able to get error messages
-                    # from stderr here ...
-                    found = True
-            if not found:
-                unmanaged = self.managed
-            else:
-                info = self.managed
-        except subprocess.CalledProcessError:
-            unmanaged = self.managed
-        return info, unmanaged
+    @classmethod
+    def bundle_debs(cls, managed):
+        '''Returns the .deb files in *BUNDLE_DIR* needed to install
+        *managed*, i.e. the packages themselves and, recursively, their
+        dependencies which are not installed yet. Installing the whole
+        bundle would downgrade packages already installed in newer
+        versions.'''
+        debs = {}
+        apt_dir = os.path.join(BUNDLE_DIR, 'apt')
+        if os.path.isdir(apt_dir):
+            for filename in os.listdir(apt_dir):
+                if filename.endswith('.deb'):
+                    # ex: libc6_2.31-0ubuntu9_amd64.deb
+                    debs[filename.split('_')[0]] = os.path.join(
+                        apt_dir, filename)
+        needed = []
+        pending = list(managed)
+        while len(pending) > 0:
+            name = pending.pop(0)
+            if name in needed or not name in debs:
+                continue
+            needed += [name]
+            for line in cls._query_output(['dpkg-deb', '-f', debs[name],
+                    'Pre-Depends', 'Depends']).splitlines():
+                for clause in line.split(':', 1)[-1].split(','):
+                    # ex: libc6 (>= 2.14) | libc6-udeb, debconf:any
+                    alternates = [re.split(r'[\s(:]', alternate.strip())[0]
+                        for alternate in clause.split('|')]
+                    installed, _ = cls.snapshot(alternates)
+                    if [alternate for alternate in alternates
+                        if alternate in installed]:
+                        continue
+                    for alternate in alternates:
+                        if alternate in debs:
+                            pending += [alternate]
+                            break
+        return [debs[name] for name in needed]
+
+    def bundle_commands(self, managed, bundle_dir):
+        # apt-get download does not follow dependencies so we ask
+        # apt-cache for the packages a fresh system would need.
+        names = set([])
+        for line in self._query_output(['apt-cache', 'depends', '--recurse',
+                '--no-recommends', '--no-suggests', '--no-conflicts',
+                '--no-breaks', '--no-replaces', '--no-enhances']
+                + list(managed)).splitlines():
+            # Dependencies are indented and virtual packages are
+            # between angle brackets (ex: <debconf-2.0>).
+            if re.match(r'^\w', line):
+                names |= set([line.strip()])
+        return [(['cd', os.path.join(bundle_dir, 'apt'), '&&',
+            '/usr/bin/apt-get', 'download'] + sorted(names), False, False)]
+
+    def install(self, managed, context):
+        # Commands printed by `dws deps` or written in a Dockerfile always
+        # update the package lists. Here we know the state of the local
+        # package lists.
+        for cmdline, admin, noexecute in self.install_commands(
+                managed, context,
+                update=not BUNDLE_DIR and self.lists_outdated(context)):
+            shell_command(cmdline, admin=admin, noexecute=noexecute)
+        self.invalidate_snapshot()
+
+    @classmethod
+    def query(cls, names):
+        # apt-cache policy reports both the installed and the candidate
+        # version of each package it knows about.
+        installed = {}
+        available = {}
+        name = None
+        for line in cls._query_output(
+                ['apt-cache', 'policy'] + names).splitlines():
+            look = re.match(r'^(\S+):$', line)
+            if look:
+                name = look.group(1)
+                continue
+            look = re.match(r'^\s+(Installed|Candidate):\s+(\S+)', line)
+            if look and name and look.group(2) != '(none)':
+                if look.group(1) == 'Installed':
+                    installed[name] = look.group(2)
+                else:
+                    available[name] = look.group(2)
+        return installed, available
 
 
 class DarwinInstallStep(InstallStep):
@@ -2131,7 +3406,7 @@ class DpkgInstallStep(InstallStep):
         if managed:
             admin = True
             noexecute = context.nonative
-            return [(['dpkg', '-i', ' '.join(managed)], admin, noexecute)]
+            return [(['dpkg', '-i'] + managed, admin, noexecute)]
         return []
 
 
@@ -2169,18 +3444,21 @@ class GemInstallStep(InstallStep):
                 '--install-dir', site_packages], admin, noexecute)]
         return []
 
-    def info(self):
-        info = []
-        unmanaged = []
-        try:
-            # XXX There are no pip info command, search is the closest we get.
-            # Pip search might match other packages and thus returns zero
-            # inadvertently but it is the closest we get so far.
-            shell_command([find_gem(CONTEXT), 'search'] + self.managed)
-            info = self.managed
-        except Error:
-            unmanaged = self.managed
-        return info, unmanaged
+    @classmethod
+    def query(cls, names):
+        gem = find_gem(CONTEXT)
+        installed = {}
+        available = {}
+        for versions, output in [
+                (installed, cls._query_output([gem, 'list', '--local'])),
+                (available, cls._query_output([gem, 'search',
+                    '^(%s)$' % '|'.join([re.escape(name)
+                                           for name in names])]))]:
+            for line in output.splitlines():
+                look = re.match(r'^(\S+) \(([^,\s)]+)', line)
+                if look and look.group(1) in names:
+                    versions[look.group(1)] = look.group(2)
+        return installed, available
 
 
 class MacPortInstallStep(InstallStep):
@@ -2201,15 +3479,21 @@ class MacPortInstallStep(InstallStep):
                 admin, noexecute)]
         return []
 
-    def info(self):
-        info = []
-        unmanaged = []
-        try:
-            shell_command(['port', 'info'] + self.managed)
-            info = self.managed
-        except Error:
-            unmanaged = self.managed
-        return info, unmanaged
+    @classmethod
+    def query(cls, names):
+        installed = {}
+        available = {}
+        for line in cls._query_output(
+                ['port', '-q', 'installed'] + names).splitlines():
+            look = re.match(r'^\s*(\S+) @(\S+)', line)
+            if look:
+                installed[look.group(1)] = look.group(2)
+        for line in cls._query_output(['port', '-q', 'info', '--line',
+                '--name', '--version'] + names).splitlines():
+            look = re.match(r'^(\S+)\s+(\S+)', line)
+            if look:
+                available[look.group(1)] = look.group(2)
+        return installed, available
 
 
 class NpmInstallStep(InstallStep):
@@ -2247,21 +3531,32 @@ class NpmInstallStep(InstallStep):
                 admin, noexecute)]
         return []
 
-    def info(self):
-        info = []
-        unmanaged = []
+    @classmethod
+    def query(cls, names):
+        installed = {}
         try:
-            shell_command([self._manager(CONTEXT), 'search'] + self.managed)
-            info = self.managed
-        except Error:
-            unmanaged = self.managed
-        return info, unmanaged
+            dependencies = json.loads(cls._query_output([
+                cls._manager(CONTEXT), 'ls', '-g', '--json', '--depth=0',
+                '--prefix', CONTEXT.value('installTop')]) or '{}').get(
+                'dependencies', {})
+        except ValueError:
+            dependencies = {}
+        for name, pkg in _iteritems(dependencies):
+            installed[name] = pkg.get('version')
+        # There is no cheap way to ask the registry about many packages
+        # at once. We let `npm install` fail on the ones it cannot find.
+        available = dict([(name, None) for name in names])
+        return installed, available
 
 
 class PipInstallStep(InstallStep):
     """
     Install a prerequisite to a project through pip.
     """
+
+    # site-packages directory per pip executable (see *site_packages*).
+    site_packages_dirs = {}
+
     def __init__(self, project_name, alt_names=None,
                  versions=None, target=None):
         super(PipInstallStep, self).__init__(project_name,
@@ -2282,7 +3577,8 @@ class PipInstallStep(InstallStep):
 </dep>
 ''' % (prerequisite, prerequisite))
 
-    def install_commands(self, managed, context):
+    def requirements(self, managed):
+        '''Returns the pip requirement specifiers for *managed*.'''
         packages = []
         for dep_name in managed:
             include_versions = self.managed[dep_name].get('includes', [])
@@ -2290,39 +3586,64 @@ class PipInstallStep(InstallStep):
                 packages += ['%s==%s' % (dep_name, include_versions[0])]
             else:
                 packages += [dep_name]
+        return packages
+
+    def bundle_commands(self, managed, bundle_dir):
+        return [([find_pip(CONTEXT), 'download', '-d',
+            os.path.join(bundle_dir, 'pip')] + self.requirements(managed),
+            False, False)]
+
+    def install_commands(self, managed, context):
+        packages = self.requirements(managed)
         # In most cases, when installing through pip, we should be running
         # under virtualenv.
         pip = find_pip(context)
-        site_packages = None
-        pip_version = subprocess.check_output(
-            [pip, '-V']).decode(DEFAULT_ENCODING)
-        look = re.match(r'pip [0-9\.]+ from (\S+)', pip_version)
-        if look:
-            site_packages = look.group(1)
+        site_packages = self.site_packages(pip)
         admin = False
         noexecute = False
-        if os.stat(site_packages).st_uid != os.getuid():
+        if site_packages and os.stat(site_packages).st_uid != os.getuid():
             admin = True
             noexecute = context.nonative
         if packages:
             return [([pip, '--log-file', os.path.join(
                 context.value('buildTop'), 'pip.log'),
             '--cache-dir', context.obj_dir('.cache/pip'),
-            'install'] + packages, admin, noexecute)]
+            'install'] + pip_bundle_options() + packages, admin, noexecute)]
         return []
 
-    def info(self):
-        info = []
-        unmanaged = []
+    @staticmethod
+    def normalize(name):
+        return re.sub(r'[-_.]+', '-', name).lower()
+
+    @classmethod
+    def site_packages(cls, pip):
+        '''Returns the site-packages directory *pip* installs into.'''
+        if not pip in cls.site_packages_dirs:
+            cls.site_packages_dirs[pip] = None
+            pip_version = subprocess.check_output(
+                [pip, '-V']).decode(DEFAULT_ENCODING)
+            look = re.match(r'pip [0-9\.]+ from (\S+)', pip_version)
+            if look:
+                cls.site_packages_dirs[pip] = look.group(1)
+        return cls.site_packages_dirs[pip]
+
+    @classmethod
+    def query(cls, names):
+        installed = {}
         try:
-            # XXX There are no pip info command, search is the closest we get.
-            # Pip search might match other packages and thus returns zero
-            # inadvertently but it is the closest we get so far.
-            shell_command([find_pip(CONTEXT), 'search'] + self.managed)
-            info = self.managed
-        except Error:
-            unmanaged = self.managed
-        return info, unmanaged
+            packages = json.loads(cls._query_output(
+                [find_pip(CONTEXT), 'list', '--format=json']) or '[]')
+        except ValueError:
+            packages = []
+        versions = dict([(cls.normalize(pkg['name']), pkg['version'])
+            for pkg in packages])
+        for name in names:
+            if cls.normalize(name) in versions:
+                installed[name] = versions[cls.normalize(name)]
+        # XXX There are no pip info command for a remote index.
+        # We let `pip install` fail on the packages it cannot find.
+        available = dict([(name, None) for name in names])
+        return installed, available
 
 
 class RpmInstallStep(InstallStep):
@@ -2365,13 +3686,72 @@ class DnfInstallStep(InstallStep):
         if managed:
             admin = True
             noexecute = context.nonative
+            if BUNDLE_DIR:
+                rpms = DnfInstallStep.bundle_rpms(managed)
+                if not rpms:
+                    return []
+                return [(['dnf', '-y', '--disablerepo=*', 'install'] + rpms,
+                    admin, noexecute)]
             return [
                 (['dnf', '-y', 'update'], admin, noexecute),
                 (['dnf', '-y', 'install'] + managed, admin, noexecute)]
         return []
 
+    @classmethod
+    def bundle_rpms(cls, managed):
+        '''Returns the .rpm files in *BUNDLE_DIR* needed to install
+        *managed*, i.e. the packages themselves and, recursively, the
+        packages providing their requirements which are not installed yet.
+        Installing the whole bundle would downgrade packages already
+        installed in newer versions.'''
+        rpms = {}
+        provides = {}
+        dnf_dir = os.path.join(BUNDLE_DIR, 'dnf')
+        if os.path.isdir(dnf_dir):
+            filenames = [os.path.join(dnf_dir, filename)
+                for filename in sorted(os.listdir(dnf_dir))
+                if filename.endswith('.rpm')]
+            if filenames:
+                # rpm prints one line per file, in the order of the arguments.
+                for filename, name in zip(filenames, cls._query_output(
+                        ['rpm', '-qp', '--qf', '%{NAME}\\n']
+                        + filenames).splitlines()):
+                    rpms[name] = filename
+                for line in cls._query_output(['rpm', '-qp', '--qf',
+                        '[%{=NAME} %{PROVIDES}\\n][%{=NAME} %{FILENAMES}\\n]']
+                        + filenames).splitlines():
+                    name, _, capability = line.partition(' ')
+                    if not capability in provides:
+                        provides[capability] = name
+        installed = set(cls._query_output(
+            ['rpm', '-qa', '--qf', '[%{PROVIDES}\\n]']).splitlines())
+        needed = []
+        pending = list(managed)
+        while len(pending) > 0:
+            name = pending.pop(0)
+            if name in needed or not name in rpms:
+                continue
+            needed += [name]
+            for capability in cls._query_output(['rpm', '-qp', '--qf',
+                    '[%{REQUIRENAME}\\n]', rpms[name]]).splitlines():
+                # ex: libc.so.6()(64bit), /bin/sh, rpmlib(PayloadIsXz)
+                if (capability.startswith('rpmlib(')
+                    or capability in installed
+                    or (capability.startswith('/')
+                        and os.path.exists(capability))):
+                    continue
+                if capability in provides:
+                    pending += [provides[capability]]
+        return [rpms[name] for name in needed]
+
+    def bundle_commands(self, managed, bundle_dir):
+        return [(['dnf', 'download', '--resolve', '--alldeps', '--destdir',
+            os.path.join(bundle_dir, 'dnf')] + managed, False, False)]
+
     def install(self, managed, context):
-        if managed:
+        if managed and BUNDLE_DIR:
+            super(DnfInstallStep, self).install(managed, context)
+        elif managed:
             # XXX Might not be the best place to do this,
             # yet CentOS does not include basic tools such as fail2ban.
             if context.host() == 'CentOS' and not os.path.exists(
@@ -2380,7 +3760,7 @@ class DnfInstallStep(InstallStep):
 'https://dl.fedoraproject.org/pub/epel/7/x86_64/e/epel-release-7-5.noarch.rpm'],
                 admin=True, noexecute=context.nonative)
             update_cmd, install_cmd = self.install_commands(managed, context)
-            log_info("update, then run: %s" % ' '.join(install_cmd[0]),
+            log_info("update, then run: %s" % shell_cmdline(install_cmd[0]),
                 context=context)
             shell_command(update_cmd[0],
                 admin=update_cmd[1], noexecute=update_cmd[2])
@@ -2394,19 +3774,24 @@ class DnfInstallStep(InstallStep):
                     if unmanaged:
                         raise Error("dnf cannot install " + ' '.join(unmanaged))
 
-    def info(self):
-        info = []
-        unmanaged = []
-        try:
-            filtered = shell_command(['dnf', 'info'] + self.managed,
-                pat=r'Name\s*:\s*(\S+)')
-            if filtered:
-                info = self.managed
+    @classmethod
+    def query(cls, names):
+        # dnf list prints an "Installed Packages" and an "Available Packages"
+        # section with "name.arch version repo" lines.
+        installed = {}
+        available = {}
+        versions = installed
+        for line in cls._query_output(
+                ['dnf', '-q', 'list'] + names).splitlines():
+            if line.startswith('Installed'):
+                versions = installed
+            elif line.startswith('Available'):
+                versions = available
             else:
-                unmanaged = self.managed
-        except Error:
-            unmanaged = self.managed
-        return info, unmanaged
+                look = re.match(r'^(\S+)\.[^.\s]+\s+(\S+)', line)
+                if look:
+                    versions[look.group(1)] = look.group(2)
+        return installed, available
 
 
 class BuildStep(TargetStep):
@@ -2422,6 +3807,15 @@ class BuildStep(TargetStep):
             updated_prerequisites |= prereq.updated
         return self.force_update or updated_prerequisites
 
+    @staticmethod
+    def invalidate_search_paths(context):
+        '''Forgets the search paths of *context* and the global context
+        since building a project might create directories they include
+        (ex: *installTop*/bin on a fresh workspace).'''
+        context.invalidate_search_paths()
+        if CONTEXT is not None and CONTEXT is not context:
+            CONTEXT.invalidate_search_paths()
+
 
 class MakeStep(BuildStep):
     '''The *make* step in the development cycle builds executable binaries,
@@ -2438,6 +3832,30 @@ class MakeStep(BuildStep):
             # is still a good idea to permit "make" from the command line.
             # Otherwise it just duplicates setting some variables.
             context = localize_context(context, self.project, self.target)
+            artifacts = find_artifact_cache()
+            artifact_key = None
+            if artifacts is not None:
+                # The key is computed even when the step is up-to-date
+                # such that dependents can compute their own.
+                install_top = context.value('installTop')
+                artifact_key = artifacts.key(self, context)
+            fingerprint = None
+            if BUILD_STATE is not None:
+                fingerprint = BUILD_STATE.fingerprint(self, context)
+                if BUILD_STATE.is_uptodate(self, fingerprint):
+                    log_info("%s is up-to-date." % self.title)
+                    self.updated = False
+                    return
+            if artifact_key is not None:
+                if artifacts.restore(artifact_key, install_top):
+                    log_info("%s restored from artifact %s."
+                        % (self.title, artifact_key))
+                    if BUILD_STATE is not None:
+                        BUILD_STATE.record(self, fingerprint)
+                    self.invalidate_search_paths(context)
+                    self.updated = True
+                    return
+                installed = artifacts.snapshot(install_top)
             makefile = context.src_dir(os.path.join(self.project, 'Makefile'))
             if os.path.isfile(makefile):
                 cmdline = ['make',
@@ -2454,9 +3872,17 @@ class MakeStep(BuildStep):
                 # XXX We should only have to include binBuildDir is PATH
                 # but that fails because of "/usr/bin/env python" statements
                 # and other little tools like hostname, date, etc.
-                shell_command(cmdline + context.targets + context.overrides,
-                    search_path=[context.bin_build_dir()]
-                              + context.search_path('bin'))
+                try:
+                    shell_command(
+                        cmdline + context.targets + context.overrides,
+                        search_path=[context.bin_build_dir()]
+                                  + context.search_path('bin'))
+                finally:
+                    self.invalidate_search_paths(context)
+            if artifact_key is not None:
+                artifacts.store(artifact_key, install_top, installed)
+            if BUILD_STATE is not None:
+                BUILD_STATE.record(self, fingerprint)
             self.updated = True
 
 
@@ -2478,9 +3904,12 @@ class ShellStep(BuildStep):
             script.write('. ' + context.config_filename + '\n\n')
             script.write(self.script)
             script.close()
-            shell_command(['sh', '-x', '-e', script.name],
-                search_path=[context.bin_build_dir()]
-                          + context.search_path('bin'))
+            try:
+                shell_command(['sh', '-x', '-e', script.name],
+                    search_path=[context.bin_build_dir()]
+                              + context.search_path('bin'))
+            finally:
+                self.invalidate_search_paths(context)
             os.remove(script.name)
             self.updated = True
 
@@ -2625,6 +4054,31 @@ class GitRepository(Repository):
               '-o', output_name, 'HEAD'])
         os.chdir(cwd)
 
+    @staticmethod
+    def is_uptodate(git_executable, context=None):
+        '''Returns True when the upstream (@{u}) of the branch checked out
+        in the current directory points to the commit already checked out.
+        This only costs a `git ls-remote` round-trip instead of a full
+        `git pull`.'''
+        def _git(*args):
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.check_output([git_executable] + list(args),
+                    stderr=devnull).decode(DEFAULT_ENCODING).strip()
+        try:
+            head = _git('rev-parse', 'HEAD')
+            branch = _git('symbolic-ref', '--short', 'HEAD')
+            remote = _git('config', 'branch.%s.remote' % branch)
+            merge = _git('config', 'branch.%s.merge' % branch)
+            upstream = _git('ls-remote', remote, merge)
+        except (OSError, subprocess.CalledProcessError):
+            # No upstream configured, etc. We will let `git pull` report
+            # the error, if any.
+            return False
+        if upstream and upstream.split()[0] == head:
+            log_info("%s is up-to-date" % head, context=context)
+            return True
+        return False
+
     def update(self, name, context, force=False):
         # If the path to the remote repository is not absolute,
         # derive it from *remoteTop*. Binding any sooner will
@@ -2649,25 +4103,26 @@ class GitRepository(Repository):
             os.chdir(local)
             # Make sure we are not on a detached HEAD.
             shell_command([git_executable, 'checkout', 'master'])
-            # 'pull' does fetch and rebase all in one.
-            cmdline = ' '.join([git_executable, 'pull'])
-            log_info(cmdline, context=context)
-            cmd = subprocess.Popen(cmdline,
-                                   shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-            line = cmd.stdout.readline().decode(DEFAULT_ENCODING)
-            while line != '':
-                log_info(line.strip(), context=context)
-                look = re.match(r'^[Uu]pdating', line)
-                if look:
-                    updated = True
+            if not self.is_uptodate(git_executable, context):
+                # 'pull' does fetch and rebase all in one.
+                cmdline = ' '.join([git_executable, 'pull'])
+                log_info(cmdline, context=context)
+                cmd = subprocess.Popen(cmdline,
+                                       shell=True,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
                 line = cmd.stdout.readline().decode(DEFAULT_ENCODING)
-            cmd.wait()
-            if cmd.returncode != 0:
-                # It is ok to get an error in case we are running
-                # this on the server machine.
-                pass
+                while line != '':
+                    log_info(line.strip(), context=context)
+                    look = re.match(r'^[Uu]pdating', line)
+                    if look:
+                        updated = True
+                    line = cmd.stdout.readline().decode(DEFAULT_ENCODING)
+                cmd.wait()
+                if cmd.returncode != 0:
+                    # It is ok to get an error in case we are running
+                    # this on the server machine.
+                    pass
         if self.rev:
             cof = '-m'
             if force:
@@ -2956,6 +4411,9 @@ class XMLDbParser(xml.sax.ContentHandler):
     tagProject = 'project'
     tagPattern = '.*<' + tagProject + r'\s+name="(.*)"'
     trailerTxt = '</' + tagDb + '>'
+    tagRegex = re.compile(tagPattern)
+    trailerRegex = re.compile('.*' + trailerTxt)
+    projectEndRegex = re.compile('.*</' + tagProject + '>')
     # For dbldpkg
     tagPackage = 'package'
     tagTag = 'tag'
@@ -3084,6 +4542,23 @@ class XMLDbParser(xml.sax.ContentHandler):
             line = db_prev.readline()
         return name
 
+    def projects(self, db_prev):
+        '''Iterates through the db_prev file and yields a (name, lines)
+        tuple for each package, where *lines* are the lines following
+        the package definition. The lines preceding the first package
+        are yielded first with a name of None.'''
+        name = None
+        lines = []
+        for line in db_prev:
+            look = self.tagRegex.match(line)
+            if look != None:
+                yield name, lines
+                name = look.group(1)
+                lines = []
+            elif not self.trailerRegex.match(line):
+                lines += [line]
+        yield name, lines
+
     def start_project(self, db_next, name):
         db_next.write('  <' + self.tagProject + ' name="' + name + '">\n')
 
@@ -3175,12 +4650,31 @@ def create_index_pathname(db_index_pathname, db_pathnames):
     dirname = os.path.dirname(db_index_pathname)
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
-    db_next = sort_build_conf_list(db_pathnames, parser)
-    db_index = open(db_index_pathname, 'wb')
-    db_next.seek(0)
-    shutil.copyfileobj(db_next, db_index)
-    db_next.close()
-    db_index.close()
+    if len(db_pathnames) == 0:
+        return
+    if len(db_pathnames) == 1:
+        shutil.copyfile(db_pathnames[0], db_index_pathname)
+        return
+    # We write the index next to its final location and rename it
+    # such that readers never see a partially written index.
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=dirname,
+        prefix=os.path.basename(db_index_pathname))
+    try:
+        with os.fdopen(tmp_fd, 'w') as db_next:
+            sort_build_conf_list(db_pathnames, parser, db_next)
+        # *mkstemp* creates the file readable by its owner only while
+        # indices are served to other users.
+        if os.path.exists(db_index_pathname):
+            shutil.copymode(db_index_pathname, tmp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+        os.rename(tmp_path, db_index_pathname)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def found_bin_suffix(candidate, variant=None):
@@ -3332,9 +4826,78 @@ def find_bin(names, search_path, build_top, versions=None, variant=None):
     return results, version, complete
 
 
-def find_cache(context, names):
+def _sha1sum(pathname, chunk_size=1024 * 1024):
+    '''Returns the sha1 hex digest of *pathname*, read in *chunk_size*
+    blocks such that large files are never loaded in memory.'''
+    digest = hashlib.sha1()
+    with open(pathname, 'rb') as local_file:
+        chunk = local_file.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = local_file.read(chunk_size)
+    return digest.hexdigest()
+
+
+def find_checksums(context):
+    '''Returns the checksum memo for the files in *siteTop*.'''
+    global CHECKSUMS
+    if CHECKSUMS is None:
+        CHECKSUMS = ChecksumMemo(os.path.join(
+            context.value('siteTop'), '.dws-sha1.json'))
+    return CHECKSUMS
+
+
+def find_downloads(context):
+    '''Returns the memo of validators for files fetched over http(s).'''
+    global DOWNLOADS
+    if DOWNLOADS is None:
+        DOWNLOADS = DownloadMemo(os.path.join(
+            context.value('buildTop'), '.dws-downloads.json'))
+    return DOWNLOADS
+
+
+def find_header_versions(build_top):
+    '''Returns the memo of version candidates found in headers.'''
+    global HEADER_VERSIONS
+    if HEADER_VERSIONS is None:
+        HEADER_VERSIONS = HeaderVersionMemo(
+            os.path.join(build_top, '.dws-header-versions.json'))
+    return HEADER_VERSIONS
+
+
+def find_cache(context, names, jobs=None):
     '''Search for the presence of files in the cache directory. *names*
-    is a dictionnary of file names used as key and the associated checksum.'''
+    is a dictionnary of file names used as key and the associated checksum.
+    Missing files found in the asset store are linked into the cache
+    directory. Checksums are computed with up to *jobs* threads.'''
+    checksums = find_checksums(context)
+    asset_store = find_asset_store()
+    to_hash = []
+    for pathname in names:
+        if isinstance(names[pathname], dict) and 'sha1' in names[pathname]:
+            local_name = context.local_dir(pathname)
+            if not os.path.exists(local_name) and asset_store:
+                asset_store.link(names[pathname]['sha1'], local_name)
+            if os.path.isfile(local_name):
+                to_hash += [local_name]
+    sha1sums = {}
+    if to_hash:
+        jobs = min(jobs or _cpu_count(), len(to_hash))
+        if jobs <= 1:
+            sha1sums = dict([(local_name, checksums.sha1(local_name))
+                for local_name in to_hash])
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            try:
+                sha1sums = dict(zip(to_hash, pool.map(checksums.sha1, to_hash)))
+            finally:
+                pool.close()
+                pool.join()
+        if checksums.dirty:
+            checksums.save()
+    if asset_store:
+        asset_store.save()
     results = {}
     for pathname in names:
         name = os.path.basename(_urlparse(pathname).path)
@@ -3346,9 +4909,7 @@ def find_cache(context, names):
             if isinstance(names[pathname], dict):
                 if 'sha1' in names[pathname]:
                     expected = names[pathname]['sha1']
-                    with open(local_name, 'rb') as local_file:
-                        sha1sum = hashlib.sha1(local_file.read()).hexdigest()
-                    if sha1sum == expected:
+                    if sha1sums[local_name] == expected:
                         # checksum are matching
                         log_info("matched (sha1)", context=context)
                     else:
@@ -3399,6 +4960,59 @@ def find_files(base, name_pat, recurse=True):
     return sorted(result, reverse=True)
 
 
+def _scan_dir(base):
+    '''Returns the (files, subdirs) in directory *base*.'''
+    files = []
+    subdirs = []
+    try:
+        if _scandir:
+            for entry in _scandir(base):
+                if entry.is_dir():
+                    subdirs += [entry.path]
+                else:
+                    files += [entry.path]
+        else:
+            for name in os.listdir(base):
+                path = os.path.join(base, name)
+                if os.path.isdir(path):
+                    subdirs += [path]
+                else:
+                    files += [path]
+    except OSError:
+        # In case permission to list the directory is denied.
+        pass
+    return files, subdirs
+
+
+def find_files_by_pats(roots, name_pats, jobs=None):
+    '''Walks the directory trees rooted at *roots* once and returns
+    a dictionary mapping each key in *name_pats* to the list of files
+    matching the associated pattern (as in *find_files*).
+    Directories are listed in parallel, level by level.'''
+    from multiprocessing.pool import ThreadPool
+    regexes = [(key, re.compile('.*' + name_pat + '$'))
+               for key, name_pat in _iteritems(name_pats)]
+    results = dict([(key, []) for key in name_pats])
+    pool = ThreadPool(jobs or min(32, _cpu_count() * 4))
+    try:
+        level = [root for root in roots if os.path.isdir(root)]
+        while len(level) > 0:
+            next_level = []
+            for files, subdirs in pool.map(_scan_dir, level):
+                for path in files:
+                    for key, regex in regexes:
+                        if regex.match(path):
+                            results[key] += [path]
+                next_level += subdirs
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+    for key in results:
+        results[key] = sorted(results[key], reverse=True)
+    return results
+
+
 def find_first_files(base, name_pat, subdir=''):
     '''Search the directory tree rooted at *base* for files matching pattern
     *name_pat* and returns a list of relative pathnames to those files
@@ -3534,6 +5148,7 @@ def find_include(names, search_path, build_top, versions=None, variant=None):
     complete = True
     prefix = ''
     include_sys_dirs = search_path
+    header_versions = find_header_versions(build_top)
     for name_pat, absolute_path in names:
         if absolute_path != None and os.path.exists(absolute_path):
             # absolute paths only occur when the search has already been
@@ -3569,15 +5184,9 @@ def find_include(names, search_path, build_top, versions=None, variant=None):
                             numbers += [ver]
                 # Second open the file and search for a version identifier...
                 header = os.path.join(include_sys_dir, header)
-                with open(header) as header_file:
-                    line = header_file.readline()
-                    while line != '':
-                        look = re.match(r'\s*#define.*VERSION\s+(\S+)', line)
-                        if look != None:
-                            for ver in version_candidates(look.group(1)):
-                                if not ver in numbers:
-                                    numbers += [ver]
-                        line = header_file.readline()
+                for ver in header_versions.versions(header):
+                    if not ver in numbers:
+                        numbers += [ver]
                 # At this point *numbers* contains a list that can
                 # interpreted as versions. Hopefully, there is only
                 # one candidate.
@@ -3600,17 +5209,14 @@ def find_include(names, search_path, build_top, versions=None, variant=None):
                                 excluded = True
                                 break
                     if not excluded:
-                        index = 0
-                        for include in includes:
-                            if ((not include[1])
-                                or version_compare(include[1], numbers[0]) < 0):
-                                break
-                            index = index + 1
-                        includes.insert(index, (header, numbers[0]))
+                        includes.append((header, numbers[0]))
                 else:
                     # If we find no version number, we append the header
                     # at the end of the list with 'None' for version.
                     includes.append((header, None))
+            # Higher version number first. The sort is stable so headers
+            # with the same version remain in the order they were found.
+            includes = sorted(includes, key=candidate_sort_key, reverse=True)
             if includes:
                 if includes[0][1]:
                     version = includes[0][1]
@@ -3636,6 +5242,8 @@ def find_include(names, search_path, build_top, versions=None, variant=None):
             log_info("no")
             results.append((name_pat, None))
             complete = False
+    if header_versions.dirty:
+        header_versions.save()
     return results, version, complete
 
 
@@ -3767,34 +5375,15 @@ def find_lib(names, search_path, build_top, versions=None, variant=None):
                                 excluded = True
                                 break
                     if not excluded:
-                        # Insert candidate into a sorted list. First to last,
-                        # higher version number, dynamic libraries.
-                        index = 0
-                        for lib in libs:
-                            lib_path_base = os.path.dirname(lib[0])
-                            if ((not lib[1])
-                                or version_compare(lib[1], numbers[0]) < 0):
-                                break
-                            elif (absolute_path_base == lib_path_base
-                                and absolute_path_ext == lib_priority_suffix):
-                                break
-                            index = index + 1
-                        libs.insert(index, (absolute_path, numbers[0]))
+                        libs.append((absolute_path, numbers[0],
+                            absolute_path_ext == lib_priority_suffix))
                 else:
-                    # Insert candidate into a sorted list. First to last,
-                    # higher version number, shortest name, dynamic libraries.
-                    index = 0
-                    for lib in libs:
-                        lib_path_base = os.path.dirname(lib[0])
-                        if lib[1]:
-                            pass
-                        elif absolute_path_base == lib_path_base:
-                            if absolute_path_ext == lib_priority_suffix:
-                                break
-                        elif lib_path_base.startswith(absolute_path_base):
-                            break
-                        index = index + 1
-                    libs.insert(index, (absolute_path, None))
+                    libs.append((absolute_path, None,
+                        absolute_path_ext == lib_priority_suffix))
+            # First to last: higher version number, *lib_priority_suffix*
+            # (static or dynamic libraries), shortest directory.
+            libs = sorted(libs, key=lambda lib: candidate_sort_key(lib) + (
+                lib[2], -len(os.path.dirname(lib[0]))), reverse=True)
             if libs:
                 candidate = libs[0][0]
                 version = libs[0][1]
@@ -4032,7 +5621,7 @@ def find_rsync(host, context=None, relative=True, admin=False,
             ssh = ssh + ' -t'
         if key:
             ssh = ssh + ' -i ' + str(key)
-        ssh = ssh + '"'
+        ssh = ssh + ' ' + ' '.join(ssh_options(host, username, key)) + '"'
         cmdline += [ssh]
     if admin and username != 'root':
         cmdline += ['--rsync-path', 'sudo /usr/bin/rsync']
@@ -4040,6 +5629,64 @@ def find_rsync(host, context=None, relative=True, admin=False,
         cmdline += ['--rsync-path', '/usr/bin/rsync']
     return cmdline, prefix
 
+
+class SshControlMaster(object):
+    '''Shares one ssh connection per (host, username, key) between all
+    the ssh and rsync commands of a dws run through the OpenSSH
+    ControlMaster feature. The first command to a host starts a master
+    connection in the background, the following ones reuse its socket
+    in *control_dir* instead of going through a new key exchange.
+    *close* stops the masters and it runs when the script exits. In case
+    it does not (crash, SIGKILL), masters exit after *persist* seconds
+    without connections.'''
+
+    persist = 60
+
+    def __init__(self):
+        self.control_dir = None
+        self.masters = {}
+
+    def options(self, host, username=None, key=None):
+        '''Returns the ssh command line options to connect to *host*
+        through its master connection.'''
+        if os.name != 'posix':
+            return []
+        if self.control_dir is None:
+            import atexit
+            # Unix socket paths are limited to ~100 characters so we keep
+            # *control_dir* short.
+            self.control_dir = tempfile.mkdtemp(prefix='dws-ssh-', dir='/tmp')
+            atexit.register(self.close)
+        connect = (username + '@' + host) if username else host
+        master_key = (connect, str(key) if key else None)
+        if not master_key in self.masters:
+            self.masters[master_key] = os.path.join(self.control_dir,
+                hashlib.sha1(repr(master_key).encode('utf-8')).hexdigest()[:12])
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=' + self.masters[master_key],
+                '-o', 'ControlPersist=%d' % self.persist]
+
+    def close(self):
+        for (connect, _), control_path in _iteritems(self.masters):
+            if os.path.exists(control_path):
+                subprocess.call(['ssh', '-q', '-o', 'ControlPath='
+                    + control_path, '-O', 'exit', connect],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.masters = {}
+        if self.control_dir and os.path.isdir(self.control_dir):
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+
+
+def ssh_options(host, username=None, key=None):
+    '''Returns the ssh command line options to reuse the master connection
+    to *host* (see *SshControlMaster*).'''
+    global SSH_CONTROL
+    if SSH_CONTROL is None:
+        SSH_CONTROL = SshControlMaster()
+    return SSH_CONTROL.options(host, username=username, key=key)
+
+
 def find_virtualenv(context, version=3):
     virtual_package = 'python-virtualenv'
     find_boot_bin(r"(virtualenv)(-%d\.\d)?" % version,
@@ -4098,6 +5745,239 @@ def ordered_prerequisites(dgen, dbindex, graph=False):
     return globbed
 
 
+class Downloader(object):
+    '''Downloads files over http(s), reusing one keep-alive connection
+    per host in each thread.
+
+    Files are streamed in *chunk_size* blocks into a *localname*.part file,
+    checked against their expected sha1 while they are written and renamed
+    into place once complete. An interrupted download is resumed from
+    the .part file through a Range request, provided there is a sha1
+    to check the result against. When a previous download
+    recorded the ETag or Last-Modified headers of the server response
+    (see *find_downloads*), the download is conditional and a 304 response
+    keeps the local copy.'''
+
+    chunk_size = 64 * 1024
+    max_redirects = 5
+
+    def __init__(self, context=None):
+        import threading
+        self.context = context
+        self.memo = None
+        if context is not None:
+            self.memo = find_downloads(context)
+        self.local = threading.local()
+        # Connections opened by all threads, closed by *close()*.
+        self.connections = []
+
+    @staticmethod
+    def proxy(scheme, netloc):
+        '''Returns the (host, headers) of the proxy to reach *netloc*
+        through, as set in the *scheme*_proxy and no_proxy environment
+        variables, or None.'''
+        try:
+            from urllib.request import getproxies, proxy_bypass, unquote
+        except ImportError:
+            from urllib import getproxies, proxy_bypass, unquote
+        proxy = getproxies().get(scheme)
+        if not proxy or proxy_bypass(netloc):
+            return None
+        if not '://' in proxy:
+            proxy = 'http://' + proxy
+        uri = _urlparse(proxy)
+        headers = {}
+        if uri.username:
+            import base64
+            credentials = '%s:%s' % (
+                unquote(uri.username), unquote(uri.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                credentials.encode(DEFAULT_ENCODING)).decode('ascii')
+        return uri.netloc.rpartition('@')[2], headers
+
+    def connection(self, scheme, netloc):
+        '''Returns the connection to *netloc* for the calling thread
+        and the headers to add to requests sent on it. When those are
+        not None, the connection is to a http proxy and requests must
+        be sent with an absolute url. https requests go through
+        a CONNECT tunnel instead.'''
+        try:
+            import http.client as httplib
+        except ImportError:
+            import httplib
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = {}
+            self.local.connections = connections
+        key = (scheme, netloc)
+        if not key in connections:
+            proxy = self.proxy(scheme, netloc)
+            proxy_headers = None
+            if scheme == 'https':
+                if proxy:
+                    conn = httplib.HTTPSConnection(proxy[0])
+                    conn.set_tunnel(netloc, headers=proxy[1])
+                else:
+                    conn = httplib.HTTPSConnection(netloc)
+            elif proxy:
+                conn = httplib.HTTPConnection(proxy[0])
+                proxy_headers = proxy[1]
+            else:
+                conn = httplib.HTTPConnection(netloc)
+            connections[key] = (conn, proxy_headers)
+            self.connections += [conn]
+        return connections[key]
+
+    def close(self):
+        '''Closes the connections opened by all threads. This must only
+        be called once they are done downloading.'''
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+    def request(self, url, headers):
+        '''Issues a GET for *url*, following redirects, and returns
+        the response.'''
+        for _ in range(0, self.max_redirects + 1):
+            uri = _urlparse(url)
+            path = uri.path or '/'
+            if uri.query:
+                path = path + '?' + uri.query
+            conn, proxy_headers = self.connection(uri.scheme, uri.netloc)
+            if proxy_headers is not None:
+                path = url.split('#')[0]
+                headers = dict(headers)
+                headers.update(proxy_headers)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except (socket.error, IOError):
+                # The server closed a kept-alive connection. Try once more
+                # on a fresh one.
+                conn.close()
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                # The location might be relative to *url*.
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            return resp
+        raise Error("%s: too many redirects" % url)
+
+    def download(self, remotename, localname, sha1=None, force=False):
+        '''Downloads *remotename* into *localname* unless the server reports
+        the copy we already have is current. The download is unconditional
+        when *force* is True or the copy we have does not match *sha1*.
+        Returns True when *localname* was (re-)written.'''
+        part_name = localname + '.part'
+        headers = {}
+        offset = 0
+        digest = hashlib.sha1()
+        if os.path.exists(part_name) and not sha1:
+            # Without a sha1, we could not tell a prefix of the previous
+            # remote file joined to a suffix of the current one.
+            os.remove(part_name)
+        if os.path.exists(part_name):
+            with open(part_name, 'rb') as part:
+                chunk = part.read(self.chunk_size)
+                while chunk:
+                    digest.update(chunk)
+                    offset += len(chunk)
+                    chunk = part.read(self.chunk_size)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                # The server sends the whole file when it changed since
+                # the partial download started.
+                validators = {}
+                if self.memo is not None:
+                    validators = self.memo.validators(part_name)
+                etag = validators.get('etag')
+                if etag and not etag.startswith('W/'):
+                    headers['If-Range'] = etag
+                elif validators.get('last-modified'):
+                    headers['If-Range'] = validators['last-modified']
+        elif (not force and self.memo is not None
+              and os.path.exists(localname)
+              and (not sha1 or self.sha1(localname) == sha1)):
+            validators = self.memo.validators(localname)
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                headers['If-Modified-Since'] = validators['last-modified']
+        resp = self.request(remotename, headers)
+        if resp.status == 304:
+            resp.read()
+            return False
+        if resp.status == 416 and offset:
+            # The partial file does not match the remote file anymore.
+            resp.read()
+            os.remove(part_name)
+            return self.download(remotename, localname,
+                sha1=sha1, force=force)
+        if resp.status == 200:
+            # The server ignored our Range header, if any.
+            offset = 0
+            digest = hashlib.sha1()
+        elif resp.status != 206:
+            resp.read()
+            raise Error("%s: %d %s" % (remotename, resp.status, resp.reason))
+        if self.memo is not None:
+            self.memo.record(part_name, resp)
+        with open(part_name, 'ab' if offset else 'wb') as part:
+            chunk = resp.read(self.chunk_size)
+            while chunk:
+                digest.update(chunk)
+                part.write(chunk)
+                chunk = resp.read(self.chunk_size)
+        if sha1 and digest.hexdigest() != sha1:
+            os.remove(part_name)
+            raise Error("%s: sha1 %s does not match expected %s" % (
+                remotename, digest.hexdigest(), sha1))
+        os.rename(part_name, localname)
+        if self.memo is not None:
+            self.memo.forget(part_name)
+            self.memo.record(localname, resp)
+        return True
+
+    def sha1(self, pathname):
+        if self.context is not None:
+            return find_checksums(self.context).sha1(pathname)
+        return _sha1sum(pathname)
+
+    def download_all(self, downloads, jobs=None, force=False):
+        '''Downloads all (remotename, localname, sha1) tuples in *downloads*
+        with up to *jobs* threads, each thread reusing its connections
+        from one file to the next. Returns the remote names
+        of the files that were (re-)written.'''
+        from multiprocessing.pool import ThreadPool
+
+        def _download(args):
+            remotename, localname, sha1 = args
+            log_info("fetching %s..." % remotename, context=self.context)
+            return self.download(remotename, localname,
+                sha1=sha1, force=force)
+
+        downloads = list(downloads)
+        jobs = min(jobs or FETCH_JOBS, len(downloads))
+        try:
+            if jobs <= 1:
+                updated = [_download(args) for args in downloads]
+            else:
+                pool = ThreadPool(jobs)
+                try:
+                    updated = pool.map(_download, downloads)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            self.close()
+            if self.memo is not None and self.memo.dirty:
+                self.memo.save()
+        return [args[0] for args, changed in zip(downloads, updated)
+                if changed]
+
+
 def fetch(context, filenames,
           force=False, admin=False, relative=True):
     '''download *filenames*, typically a list of distribution packages,
@@ -4141,6 +6021,18 @@ def fetch(context, filenames,
                 if not os.path.exists(dirname):
                     os.makedirs(dirname)
 
+        # Link the files we already have in the asset store.
+        asset_store = find_asset_store()
+        if asset_store:
+            for remotename in list(downloads.keys()):
+                expected = downloads[remotename]
+                if (isinstance(expected, dict) and 'sha1' in expected
+                    and asset_store.link(expected['sha1'],
+                        context.local_dir(remotename))):
+                    log_info("%s linked from the asset store" % remotename,
+                        context=context)
+                    del downloads[remotename]
+
         # Split fetches by protocol
         https = []
         sshs = []
@@ -4151,14 +6043,17 @@ def fetch(context, filenames,
             else:
                 sshs += [package]
         # fetch https
+        https_downloads = []
         for remotename in https:
             localname = context.local_dir(remotename)
             if not os.path.exists(os.path.dirname(localname)):
                 os.makedirs(os.path.dirname(localname))
-            log_info("fetching %s..." % remotename, context=context)
-            with urlopen(Request(remotename)) as remote:
-                with open(localname, 'wb') as local:
-                    local.write(remote.read())
+            sha1 = None
+            if isinstance(downloads[remotename], dict):
+                sha1 = downloads[remotename].get('sha1')
+            https_downloads += [(remotename, localname, sha1)]
+        if https_downloads:
+            Downloader(context).download_all(https_downloads, force=force)
         # fetch sshs
         if len(sshs) > 0:
             local_sources = []
@@ -4180,14 +6075,34 @@ def fetch(context, filenames,
                 shell_command(cmdline + ["'" + ' '.join(local_sources) + "'",
                                     context.value('siteTop')])
             for hostname, paths in _iteritems(remote_sources):
+                # The sudo check and rsync go through the same master
+                # connection (see *ssh_options*).
+                username = None
+                if '@' in hostname:
+                    username, hostname = hostname.split('@', 1)
                 if hostname and admin:
-                    shell_command(['stty -echo;', 'ssh', hostname,
-                              'sudo', '-v', '; stty echo'])
-                cmdline, prefix = find_rsync(
-                    hostname, context=context, relative=relative, admin=admin)
+                    shell_command(['stty -echo;', 'ssh']
+                        + ssh_options(hostname, username=username) + [
+                            (username + '@' + hostname) if username
+                            else hostname, 'sudo', '-v', '; stty echo'])
+                cmdline, prefix = find_rsync(hostname, context=context,
+                    relative=relative, admin=admin, username=username)
                 shell_command(cmdline + ["'" + prefix + ' '.join(paths) + "'",
                                     context.value('siteTop')])
 
+        # Share the files we downloaded with the other workspaces.
+        if asset_store:
+            checksums = find_checksums(context)
+            for remotename, expected in _iteritems(downloads):
+                localname = context.local_dir(remotename)
+                if (isinstance(expected, dict) and 'sha1' in expected
+                    and os.path.isfile(localname)
+                    and checksums.sha1(localname) == expected['sha1']):
+                    asset_store.add(expected['sha1'], localname)
+            if checksums.dirty:
+                checksums.save()
+            asset_store.save()
+
 
 def create_managed(project_name, versions=None, target=None):
     '''Create a step that will install *project_name* through the local
@@ -4576,6 +6491,12 @@ def runuser():
     return getpass.getuser()
 
 
+def flush_contexts():
+    '''Write the contexts saved in *WRITE_BEHIND* mode to disk.'''
+    for context in list(Context.pending_saves):
+        context.flush()
+
+
 def merge_unique(left, right):
     '''Merge a list of additions into a previously existing list.
     Or: adds elements in *right* to the end of *left* if they were not
@@ -4586,55 +6507,6 @@ def merge_unique(left, right):
     return left
 
 
-def merge_build_conf(db_prev, db_upd, parser):
-    '''Merge an updated project dependency database into an existing
-       project dependency database. The existing database has been
-       augmented by user-supplied information such as "use source
-       controlled repository", "skip version X dependency", etc. Hence
-       we do a merge instead of a complete replace.'''
-    if db_prev is None:
-        return db_upd
-    elif db_upd is None:
-        return db_prev
-    else:
-        # We try to keep user-supplied information in the prev
-        # database whenever possible.
-        # Both databases supply packages in alphabetical order,
-        # so the merge can be done in a single pass.
-        db_next = tempfile.TemporaryFile()
-        proj_prev = parser.copy(db_next, db_prev)
-        proj_upd = parser.next(db_upd)
-        while proj_prev != None and proj_upd != None:
-            if proj_prev < proj_upd:
-                parser.start_project(db_next, proj_prev)
-                proj_prev = parser.copy(db_next, db_prev)
-            elif proj_prev > proj_upd:
-                parser.start_project(db_next, proj_upd)
-                proj_upd = parser.copy(db_next, db_upd)
-            elif proj_prev == proj_upd:
-                # when names are equals, we need to import user-supplied
-                # information as appropriate. For now, there are only one
-                # user supplied-information, the install mode for the package.
-                # Package name is a unique key so we can increment
-                # both iterators.
-                parser.start_project(db_next, proj_upd)
-                #installMode, version = parser.installMode(proj_prev)
-                #parser.setInstallMode(db_next,installMode,version)
-                # It is critical this line appears after we set the installMode
-                # because it guarentees that the install mode will always be
-                # the first line after the package tag.
-                proj_upd = parser.copy(db_next, db_upd, True)
-                proj_prev = parser.copy(db_next, db_prev)
-        while proj_prev != None:
-            parser.start_project(db_next, proj_prev)
-            proj_prev = parser.copy(db_next, db_prev)
-        while proj_upd != None:
-            parser.start_project(db_next, proj_upd)
-            proj_upd = parser.copy(db_next, db_upd)
-        parser.trailer(db_next)
-        return db_next
-
-
 def upload(filenames, remote_cache_path=None):
     '''upload *filenames*, typically a list of result logs,
     to the remote server. See the fetch function for downloading
@@ -4717,6 +6589,21 @@ def search_back_to_root(filename, root=os.sep):
     return dirname, os.path.join(cur_dir, filename)
 
 
+def shell_cmdline(cmdline):
+    '''Returns the command line *shell_command* passes to the shell
+    for *cmdline*, a list of arguments. Arguments containing spaces
+    are double-quoted.'''
+    result = ""
+    for cmdline_item in cmdline:
+        if result:
+            result += " "
+        if ' ' in cmdline_item:
+            result += '"%s"' % cmdline_item
+        else:
+            result += cmdline_item
+    return result
+
+
 def shell_command(execute, admin=False, search_path=None, pat=None,
     noexecute=False, nolog=None):
     '''Execute a shell command and throws an exception when the command fails.
@@ -4724,6 +6611,9 @@ def shell_command(execute, admin=False, search_path=None, pat=None,
     the text output is filtered and returned when pat exists.
     '''
     filtered_output = []
+    # The command might read the workspace make fragment
+    # (ex: make, `dws context`).
+    flush_contexts()
     env = os.environ.copy()
     if admin and not (USER or GROUP):
         if False:
@@ -4750,14 +6640,7 @@ def shell_command(execute, admin=False, search_path=None, pat=None,
         cmdline = execute
     if search_path:
         env['PATH'] = ':'.join(search_path)
-    log_cmdline = ""
-    for cmdline_item in cmdline:
-        if log_cmdline:
-            log_cmdline += " "
-        if ' ' in cmdline_item:
-            log_cmdline += '"%s"' % cmdline_item
-        else:
-            log_cmdline += cmdline_item
+    log_cmdline = shell_cmdline(cmdline)
     if not (noexecute or DO_NOT_EXECUTE):
         log_info(log_cmdline, nolog=nolog)
     else:
@@ -4794,29 +6677,51 @@ def shell_command(execute, admin=False, search_path=None, pat=None,
     return filtered_output
 
 
-def sort_build_conf_list(db_pathnames, parser):
-    '''Sort/Merge projects defined in a list of files, *db_pathnames*.
-    *parser* is the parser used to read the projects files in.'''
-    db_prev = None
-    db_upd = None
-    if len(db_pathnames) == 0:
-        return None
-    elif len(db_pathnames) == 1:
-        db_prev = open(db_pathnames[0], 'rb')
-        return db_prev
-    elif len(db_pathnames) == 2:
-        db_prev = open(db_pathnames[0], 'rb')
-        db_upd = open(db_pathnames[1], 'rb')
-    else:
-        db_prev = sort_build_conf_list(
-            db_pathnames[:len(db_pathnames) / 2], parser)
-        db_upd = sort_build_conf_list(
-            db_pathnames[len(db_pathnames) / 2:], parser)
-    db_next = merge_build_conf(db_prev, db_upd, parser)
-    db_next.seek(0)
-    db_prev.close()
-    db_upd.close()
-    return db_next
+def sort_build_conf_list(db_pathnames, parser, db_next):
+    '''Sort/Merge projects defined in a list of files, *db_pathnames*,
+    into *db_next*. *parser* is the parser used to read the projects
+    files in.
+
+    Each file supplies projects in alphabetical order, so all files are
+    merged in a single pass. The header is taken from the first file.
+    When a project is defined in more than one file, the definitions are
+    concatenated, latest file first, into a single project.'''
+    import heapq
+    def _keyed(projects, idx):
+        # -idx such that the project found in the latest file comes first.
+        for name, lines in projects:
+            yield name, -idx, lines
+    db_files = [open(db_pathname) for db_pathname in db_pathnames]
+    try:
+        streams = []
+        for idx, db_file in enumerate(db_files):
+            projects = parser.projects(db_file)
+            _, header = next(projects)
+            if idx == 0:
+                db_next.writelines(header)
+            streams += [_keyed(projects, idx)]
+        prev_name = None
+        prev_lines = None
+        for name, _, lines in heapq.merge(*streams):
+            if name == prev_name:
+                # Same project defined in multiple files. We drop the end
+                # tag of the previous definition such that all of them
+                # end up in a single project.
+                db_next.writelines([line for line in prev_lines
+                    if not parser.projectEndRegex.match(line)])
+            else:
+                if prev_lines is not None:
+                    db_next.writelines(prev_lines)
+                parser.start_project(db_next, name)
+            prev_name = name
+            prev_lines = lines
+        if prev_lines is not None:
+            db_next.writelines(prev_lines)
+        parser.trailer(db_next)
+    finally:
+        for db_file in db_files:
+            db_file.close()
+
 
 def ssh_tunnels(hostname, ports):
     '''Create ssh tunnels from localhost to a remote host when they don't
@@ -4847,55 +6752,330 @@ def ssh_tunnels(hostname, ports):
                             + hostname + " failed.")
 
 
+def critical_path(vertices, durations):
+    '''Schedules *vertices* as early as their prerequisites allow,
+    assuming each vertex takes *durations[vertex.name]* seconds
+    (0 when missing, as for steps that were merged or not run).
+
+    Returns a tuple (schedule, path) where *schedule* maps a vertex name
+    to (vertex, earliest start, earliest finish, slack) and *path* is
+    the list of vertices on the critical path, first to last.'''
+    nodes = {}
+    dependents = {}
+    pending = list(vertices)
+    while len(pending) > 0:
+        vertex = pending.pop()
+        if vertex.name in nodes:
+            continue
+        nodes[vertex.name] = vertex
+        for prereq in vertex.prerequisites:
+            dependents.setdefault(prereq.name, set([])).add(vertex.name)
+            pending += [prereq]
+
+    earliest = {}
+    # Vertex names in topological order (prerequisites first).
+    order = []
+    def earliest_finish(name):
+        # Iterative post-order so deep chains do not hit the recursion limit.
+        stack = [name]
+        while len(stack) > 0:
+            top = stack[-1]
+            if top in earliest:
+                stack.pop()
+                continue
+            prereqs = [prereq.name for prereq in nodes[top].prerequisites
+                       if not prereq.name in earliest]
+            if prereqs:
+                stack += prereqs
+                continue
+            stack.pop()
+            begin = max([earliest[prereq.name][1]
+                         for prereq in nodes[top].prerequisites] + [0])
+            earliest[top] = (begin, begin + durations.get(top, 0))
+            order.append(top)
+        return earliest[name][1]
+
+    length = max([earliest_finish(name) for name in nodes] + [0])
+
+    # Latest finish times are computed in reverse topological order,
+    # which guarantees dependents are processed first (even when they
+    # take no time and finish with their prerequisites).
+    latest = {}
+    for name in reversed(order):
+        latest[name] = min([latest[dep] - durations.get(dep, 0)
+                            for dep in dependents.get(name, [])] + [length])
+
+    schedule = {}
+    for name, vertex in _iteritems(nodes):
+        begin, end = earliest[name]
+        schedule[name] = (vertex, begin, end, latest[name] - end)
+
+    path = []
+    current = None
+    for name, (vertex, begin, end, slack) in _iteritems(schedule):
+        if end == length and (current is None
+                              or begin > schedule[current][1]):
+            current = name
+    while current is not None:
+        vertex, begin, end, slack = schedule[current]
+        path.insert(0, vertex)
+        current = None
+        for prereq in vertex.prerequisites:
+            if schedule[prereq.name][2] == begin and (current is None
+                or schedule[prereq.name][3] < schedule[current][3]):
+                current = prereq.name
+    return schedule, path
+
+
+def write_timeline(filename, vertices, timings):
+    '''Writes a Chrome-trace (chrome://tracing, Perfetto) JSON file
+    of the build DAG in *filename*. *timings* maps a vertex name
+    to the (start, finish) times it was recorded running.
+
+    Process 1 is the recorded (serial) run. Process 2 is the same
+    steps scheduled as early as their prerequisites allow, which is
+    what a perfectly parallel build would look like. Both annotate
+    each step with its slack and whether it is on the critical path.'''
+    durations = {}
+    for name, (start, finish) in _iteritems(timings):
+        durations[name] = finish - start
+    schedule, path = critical_path(vertices, durations)
+    critical = set([vertex.name for vertex in path])
+    origin = min([start for start, _ in timings.values()])
+
+    events = [
+        {'ph': 'M', 'name': 'process_name', 'pid': 1, 'tid': 0,
+         'args': {'name': 'recorded run'}},
+        {'ph': 'M', 'name': 'process_name', 'pid': 2, 'tid': 0,
+         'args': {'name': 'earliest-start schedule'}}]
+    for name, (start, finish) in sorted(timings.items(),
+                                        key=lambda item: item[1][0]):
+        vertex, begin, end, slack = schedule[name]
+        events += [{'ph': 'X', 'pid': 1, 'tid': 1,
+            'name': vertex.title, 'cat': vertex.__class__.__name__,
+            'ts': int((start - origin) * 10**6),
+            'dur': int((finish - start) * 10**6),
+            'args': {'slack': slack, 'critical': name in critical}}]
+
+    # Greedily assign each scheduled step to the first lane free
+    # at its earliest start time.
+    lanes = []
+    for name in sorted(timings, key=lambda name: schedule[name][1:3]):
+        vertex, begin, end, slack = schedule[name]
+        for lane, free in enumerate(lanes):
+            if free <= begin:
+                break
+        else:
+            lane = len(lanes)
+            lanes += [0]
+        lanes[lane] = end
+        events += [{'ph': 'X', 'pid': 2, 'tid': lane + 1,
+            'name': vertex.title, 'cat': vertex.__class__.__name__,
+            'ts': int(begin * 10**6),
+            'dur': int((end - begin) * 10**6),
+            'args': {'slack': slack, 'critical': name in critical}}]
+
+    with open(filename, 'w') as timeline:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {
+                'critical_path': [vertex.title for vertex in path],
+                'recorded': sum(durations.values()),
+                'critical': sum([durations.get(vertex.name, 0)
+                                 for vertex in path])}},
+            timeline, indent=2)
+    log_info("critical path (%.1fs of %.1fs recorded): %s"
+        % (sum([durations.get(vertex.name, 0) for vertex in path]),
+           sum(durations.values()),
+           ' -> '.join([vertex.title for vertex in path])))
+    log_info("timeline written to %s" % filename)
+
+
+def run_vertex(vertex, dgen, timings):
+    '''Runs *vertex* in the global context, logs its outcome
+    and records its wall-clock (start, finish) in *timings*.
+    Errors are raised when *dgen* stops on the first error, otherwise
+    they are logged and added to *ERRORS*.'''
+    global ERRORS
+    errcode = 0
+    elapsed = 0
+    log_header(vertex.title)
+    start = datetime.datetime.now()
+    start_time = time.time()
+    try:
+        vertex.run(CONTEXT)
+        finish = datetime.datetime.now()
+        elapsed = elapsed_duration(start, finish)
+    except Error as err:
+        if True:
+            import traceback
+            traceback.print_exc()
+        errcode = err.code
+        ERRORS += [str(vertex)]
+        if dgen.stop_make_after_error:
+            finish = datetime.datetime.now()
+            elapsed = elapsed_duration(start, finish)
+            timings[vertex.name] = (start_time, time.time())
+            log_footer(vertex.title, elapsed, errcode)
+            raise err
+        else:
+            log_error(str(err))
+    timings[vertex.name] = (start_time, time.time())
+    log_footer(vertex.title, elapsed, errcode)
+    return errcode
+
+
+# Package manager of the install steps *run_pipelined* runs concurrently.
+PIPELINED_LANES = {Step.install_native: 'native', Step.install_gem: 'gem',
+                   Step.install_npm: 'npm', Step.install_pip: 'pip'}
+
+
+class PipelineProgress(object):
+    '''Shared progress display of the package managers installing
+    prerequisites concurrently. A line with the state of every lane
+    is printed each time one of them changes.'''
+
+    def __init__(self, lanes):
+        import threading
+        self.lock = threading.Lock()
+        self.states = dict([(lane, 'waiting') for lane in lanes])
+
+    def update(self, lane, state):
+        with self.lock:
+            self.states[lane] = state
+            sys.stdout.write('[%s]\n' % ' | '.join(['%s: %s' % (name, state)
+                for name, state in sorted(self.states.items())]))
+            sys.stdout.flush()
+
+
+def run_pipelined(vertices, dgen, timings):
+    '''Runs the install *vertices* with one thread per package manager
+    (see *PIPELINED_LANES*). Installs through the same package manager
+    run in order since package managers lock their database. A vertex
+    only starts once the vertices it depends on, directly or through
+    vertices which are not pipelined, have run.
+
+    The lanes share the process working directory, so everything that
+    changes it (bootstrapping package managers, finding the python
+    version, etc.) is done before the lanes start.'''
+    import threading
+    global LOG_PREFIX
+    lanes = {}
+    for vertex in vertices:
+        lanes.setdefault(PIPELINED_LANES[vertex.priority], []).append(vertex)
+    done = dict([(vertex.name, threading.Event()) for vertex in vertices])
+    errors = []
+    progress = PipelineProgress(lanes.keys())
+    if LOG_PREFIX is None:
+        LOG_PREFIX = threading.local()
+
+    python_version(CONTEXT)
+    for lane, find_manager in [
+            ('gem', find_gem), ('npm', find_npm), ('pip', find_pip)]:
+        if lane in lanes:
+            find_manager(CONTEXT)
+
+    def _waits_on(vertex):
+        '''Returns the pipelined vertices *vertex* depends on.'''
+        names = []
+        visited = set([])
+        pending = list(vertex.prerequisites)
+        while len(pending) > 0:
+            prereq = pending.pop()
+            if prereq.name in visited:
+                continue
+            visited |= set([prereq.name])
+            if prereq.name in done:
+                names += [prereq.name]
+            else:
+                pending += prereq.prerequisites
+        return names
+
+    def _run_lane(lane, lane_vertices):
+        LOG_PREFIX.value = '[%s] ' % lane
+        try:
+            for vertex in lane_vertices:
+                for name in _waits_on(vertex):
+                    if not done[name].is_set():
+                        progress.update(lane, 'waiting on %s' % name)
+                        done[name].wait()
+                progress.update(lane, vertex.name)
+                try:
+                    run_vertex(vertex, dgen, timings)
+                except Exception as err:
+                    # Any exception, not only *Error*, is reported
+                    # by the main thread.
+                    errors.append(err)
+                    if not isinstance(err, Error):
+                        break
+                finally:
+                    done[vertex.name].set()
+                if errors and dgen.stop_make_after_error:
+                    break
+            progress.update(lane, 'failed' if errors else 'done')
+        finally:
+            # Do not leave other lanes waiting on vertices we did not run.
+            for vertex in lane_vertices:
+                done[vertex.name].set()
+            LOG_PREFIX.value = None
+
+    prev_cwd = os.getcwd()
+    threads = [threading.Thread(target=_run_lane, args=(lane, lane_vertices))
+        for lane, lane_vertices in sorted(lanes.items())]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    os.chdir(prev_cwd)
+    if errors:
+        raise errors[0]
+
+
 def validate_controls(dgen, dbindex, graph=False,
     priorities=[Step.configure, Step.install_native,
                 Step.install_gem, Step.install_npm,
                 Step.install_pip, Step.install,
                 Step.update, Step.setup,
-                Step.make]):
+                Step.make], pipelined=False):
     '''Checkout source code files, install packages such that
     the projects specified in *repositories* can be built.
     *dbindex* is the project index that contains the dependency
     information to use. If None, the global index fetched from
     the remote machine will be used.
+    When *pipelined* is True, installs through different package
+    managers run concurrently (see *run_pipelined*).
 
     This function returns a topologicaly sorted list of projects
     in *srcTop* and an associated dictionary of Project instances.
     By iterating through the list, it is possible to 'make'
     each prerequisite project in order.'''
-    global ERRORS
-
     glob = ordered_prerequisites(dgen, dbindex, graph=graph)
 
+    # Wall-clock (start, finish) of each vertex that was run, in seconds
+    # since the epoch. Used to compute the critical path when *graph*
+    # is set.
+    timings = {}
     # \todo "make recurse" should update only projects which are missing
     # from *srcTop* and leave other projects in whatever state they are in.
     # This is different from "build" which should update all projects.
-    for vertex in glob:
-        if vertex.priority in priorities:
-            errcode = 0
-            elapsed = 0
-            prev_cwd = os.getcwd()
-            log_header(vertex.title)
-            start = datetime.datetime.now()
-            try:
-                vertex.run(CONTEXT)
-                finish = datetime.datetime.now()
-                elapsed = elapsed_duration(start, finish)
-            except Error as err:
-                if True:
-                    import traceback
-                    traceback.print_exc()
-                errcode = err.code
-                ERRORS += [str(vertex)]
-                if dgen.stop_make_after_error:
-                    finish = datetime.datetime.now()
-                    elapsed = elapsed_duration(start, finish)
-                    log_footer(vertex.title, elapsed, errcode)
-                    raise err
-                else:
-                    log_error(str(err))
-            log_footer(vertex.title, elapsed, errcode)
-            os.chdir(prev_cwd)
+    try:
+        pipelined_names = set([])
+        if pipelined:
+            installs = [vertex for vertex in glob
+                if vertex.priority in priorities
+                and vertex.priority in PIPELINED_LANES]
+            pipelined_names = set([vertex.name for vertex in installs])
+            run_pipelined(installs, dgen, timings)
+        for vertex in glob:
+            if (vertex.priority in priorities
+                and not vertex.name in pipelined_names):
+                prev_cwd = os.getcwd()
+                run_vertex(vertex, dgen, timings)
+                os.chdir(prev_cwd)
+    finally:
+        if graph and timings:
+            write_timeline(
+                os.path.splitext(CONTEXT.logname())[0] + '.json',
+                glob, timings)
 
     nb_updated_projects = len(UpdateStep.updated_sources)
     if nb_updated_projects > 0:
@@ -4905,29 +7085,67 @@ def validate_controls(dgen, dbindex, graph=False,
     return nb_updated_projects
 
 
+def validate_indices(indices, schema, state, jobs=None):
+    '''Validates the project index files *indices* against *schema*
+    with xmllint, in parallel. Files which were successfully validated
+    before and have not been modified since, as recorded in *state*
+    (a *StateStore*), are skipped.'''
+    from multiprocessing.pool import ThreadPool
+    validated = state.get('validated', {})
+    stamps = {}
+    for index in indices:
+        stats = os.stat(index)
+        stamps[index] = [stats.st_mtime, stats.st_size]
+    if validated.get('schema') != schema:
+        validated = {}
+    # Forget about index files which are not part of the collection anymore.
+    validated = dict([(index, validated[index]) for index in indices
+                      if index in validated])
+    validated['schema'] = schema
+    pending = [index for index in indices
+               if validated.get(index) != stamps[index]]
+
+    def _validate(index):
+        try:
+            cmd = subprocess.Popen(['xmllint', '--noout', '--schema', schema,
+                index], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as err:
+            return index, 1, "xmllint: %s" % str(err)
+        output, _ = cmd.communicate()
+        return index, cmd.returncode, output.decode(DEFAULT_ENCODING)
+
+    errors = []
+    if pending:
+        pool = ThreadPool(jobs or _cpu_count())
+        try:
+            for index, returncode, output in pool.imap_unordered(
+                    _validate, pending):
+                if returncode == 0:
+                    validated[index] = stamps[index]
+                else:
+                    validated.pop(index, None)
+                    log_error(output)
+                    errors += [index]
+        finally:
+            pool.close()
+            pool.join()
+    state.set('validated', validated)
+    state.save()
+    if errors:
+        raise Error("invalid project index file(s): %s" % ' '.join(errors))
+
+
 def version_candidates(line):
     '''Extract patterns from *line* that could be interpreted as a
     version numbers. That is every pattern that is a set of digits
-    separated by dots and/or underscores.'''
-    part = line
-    candidates = []
-    while part != '':
-        # numbers should be full, i.e. including '.'
-        look = re.match(r'[^0-9]*([0-9].*)', part)
-        if look:
-            part = look.group(1)
-            look = re.match(r'[^0-9]*([0-9]+([_\.][0-9]+)+)+(.*)', part)
-            if look:
-                candidates += [look.group(1)]
-                part = look.group(2)
-            else:
-                while (len(part) > 0
-                       and part[0] in ['0', '1', '2', '3', '4', '5',
-                                       '6', '7', '8', '9']):
-                    part = part[1:]
-        else:
-            part = ''
-    return candidates
+    separated by dots and/or underscores.
+
+    Only the first pattern on *line* is returned, such that a line
+    like "gcc (Ubuntu 9.4.0-1ubuntu1~20.04) 9.4.0" is a single candidate.'''
+    look = VERSION_CANDIDATE_PAT.search(line)
+    if look:
+        return [look.group(0)]
+    return []
 
 
 def bin_version_candidates(binpath, variant=None):
@@ -4963,6 +7181,8 @@ def python_version(context):
     Returns a name as typically expected for prefixes to site-packages.
     """
     dirname = context.bin_build_dir()
+    if dirname in PYTHON_VERSIONS:
+        return PYTHON_VERSIONS[dirname]
     link_name = os.path.join(dirname, 'python')
     if not os.path.exists(link_name):
         prev = os.getcwd()
@@ -4973,7 +7193,42 @@ def python_version(context):
         os.chdir(prev)
     numbers = bin_version_candidates(link_name)
     version = '.'.join(numbers[0].split('.')[:2])
-    return "python%s" % str(version)
+    PYTHON_VERSIONS[dirname] = "python%s" % str(version)
+    return PYTHON_VERSIONS[dirname]
+
+
+class Version(tuple):
+    '''Sort key for a version number. Components separated by dots
+    and/or underscores are compared as integers when they are numbers
+    (i.e. 9 < 10) and as strings otherwise, in which case they sort
+    before numbers (i.e. 1.0.rc1 < 1.0.0). When all components
+    are equal, the version with fewer components is the smaller one.'''
+
+    def __new__(cls, text):
+        components = []
+        for component in re.split(r'[._]', text):
+            if component.isdigit():
+                components += [(1, int(component), '')]
+            else:
+                components += [(0, 0, component)]
+        return super(Version, cls).__new__(cls, components)
+
+
+@_lru_cache(maxsize=1024)
+def version_key(text):
+    '''Returns the *Version* for *text*, parsing each distinct
+    version number only once.'''
+    return Version(text)
+
+
+def release_key(text):
+    '''Returns the *Version* for *text* without its trailing zero
+    components such that 1.0 and 1.0.0 compare equal, as they do
+    for pip or npm.'''
+    key = list(version_key(text))
+    while len(key) > 1 and key[-1] == (1, 0, ''):
+        key.pop()
+    return key
 
 
 def version_compare(left, right):
@@ -4981,21 +7236,45 @@ def version_compare(left, right):
 
     This function returns -1 if a *left* is less than *right*, 0 if *left
     is equal to *right* and 1 if *left* is greater than *right*.
-    It is suitable as a custom comparaison function for sorted().'''
-    left_remain = left.replace('_', '.').split('.')
-    right_remain = right.replace('_', '.').split('.')
-    while len(left_remain) > 0 and len(right_remain) > 0:
-        left_num = left_remain.pop(0)
-        right_num = right_remain.pop(0)
-        if left_num < right_num:
-            return -1
-        elif left_num > right_num:
-            return 1
-    if len(left_remain) < len(right_remain):
-        return -1
-    elif len(left_remain) > len(right_remain):
-        return 1
-    return 0
+    It is suitable as a custom comparaison function for sorted(),
+    though sorted(key=version_key) is faster.'''
+    left_key = version_key(left)
+    right_key = version_key(right)
+    return (left_key > right_key) - (left_key < right_key)
+
+
+def candidate_sort_key(candidate):
+    '''Sort key for a (pathname, version) *candidate* such that
+    sorted(reverse=True) puts the highest version first and candidates
+    without a version last.'''
+    if candidate[1]:
+        return (True, version_key(candidate[1]))
+    return (False, ())
+
+
+def version_satisfies(version, versions):
+    '''Returns True if the package *version* is the first version
+    in *versions['includes']*, when there is one, and does not fall
+    in any of the *versions['excludes']* ranges. An unknown (None)
+    *version* does not satisfy anything.
+
+    Includes are exact pins, as in the ==, @ and : install specs, except
+    that trailing zero components are not significant (i.e. 1.0 is
+    satisfied by 1.0.0 but neither by 1.0.1 nor by 1.0rc1).'''
+    if not version:
+        return False
+    # Drop the epoch and distribution revision of native packages
+    # (ex: 1:2.7.5-1ubuntu1).
+    version = re.sub(r'^\d+:', '', version)
+    version = re.sub(r'-[^-.]*[a-zA-Z+~][^-]*$|-\d+$', '', version)
+    includes = versions.get('includes', [])
+    if includes and release_key(includes[0]) != release_key(version):
+        return False
+    for exclude in versions.get('excludes', []):
+        if ((not exclude[0] or version_compare(exclude[0], version) <= 0)
+            and (not exclude[1] or version_compare(version, exclude[1]) < 0)):
+            return False
+    return True
 
 
 def version_incr(ver_num):
@@ -5003,19 +7282,34 @@ def version_incr(ver_num):
     that is greater than *v*.'''
     return ver_num + '.1'
 
-def build_subcommands_parser(parser, module):
+def build_subcommands_parser(parser, module, args=None):
     '''Returns a parser for the subcommands defined in the *module*
-    (i.e. commands starting with a 'pub_' prefix).'''
+    (i.e. commands starting with a 'pub_' prefix).
+
+    When the command line *args* is specified and names one of the
+    subcommands, only that subcommand is added to the parser. Otherwise
+    (ex: --help) all subcommands are added.'''
     mdefs = module.__dict__
-    keys = list(mdefs.keys())
+    keys = [key for key in mdefs.keys() if key.startswith('pub_')]
     keys.sort()
+    if args:
+        # The subcommand is the first positional argument once the options
+        # of *parser* (and their values) are set aside. --help is left out
+        # such that it prints the help of the subcommand.
+        _, remaining = parser.parse_known_args(
+            [arg for arg in args if not arg in ('-h', '--help')])
+        for arg in remaining:
+            if not arg.startswith('-'):
+                if 'pub_' + arg in mdefs:
+                    keys = ['pub_' + arg]
+                break
     subparsers = parser.add_subparsers(help='sub-command help')
     for command in keys:
         if command.startswith('pub_'):
             func = module.__dict__[command]
             parser = subparsers.add_parser(command[4:], help=func.__doc__)
             parser.set_defaults(func=func)
-            argspec = inspect.getargspec(func)
+            argspec = _getargspec(func)
             flags = len(argspec.args)
             if argspec.defaults:
                 flags = len(argspec.args) - len(argspec.defaults)
@@ -5048,7 +7342,7 @@ def filter_subcommand_args(func, options):
     '''Filter out all options which are not part of the function *func*
     prototype and returns a set that can be used as kwargs for calling func.'''
     kwargs = {}
-    argspec = inspect.getargspec(func)
+    argspec = _getargspec(func)
     for arg in argspec.args:
         if arg in options:
             kwargs.update({arg: getattr(options, arg)})
@@ -5127,6 +7421,7 @@ def log_init(context=None):
             # We would rather not append to the previous logfile
             # but rather create a new one.
             os.remove(context.logname())
+        import logging.config
         logging.config.dictConfig({
         'version': 1,
         'disable_existing_loggers': False,
@@ -5180,6 +7475,8 @@ def log_footer(prefix, elapsed=datetime.timedelta(), errcode=0):
 
 def log_header(message, *args, **kwargs):
     '''Write a header into the log file'''
+    if LOG_PREFIX is not None and getattr(LOG_PREFIX, 'value', None):
+        message = LOG_PREFIX.value + message
     sys.stdout.write('######## ' + message + '...\n')
     if not NO_LOG:
         if not LOGGER:
@@ -5212,6 +7509,8 @@ def log_interactive(message):
 
 def log_info(message, context=None, nolog=None, *args, **kwargs):
     '''Write a info message onto stdout and into the log file'''
+    if LOG_PREFIX is not None and getattr(LOG_PREFIX, 'value', None):
+        message = LOG_PREFIX.value + str(message)
     message_line = "%s\n" % message
     if PY3:
         sys.stdout.write(message_line)
@@ -5238,7 +7537,8 @@ def log_info(message, context=None, nolog=None, *args, **kwargs):
 
 
 def pub_build(args, graph=False, clean=False,
-              novirtualenv=False, nonative=False, python2=False):
+              novirtualenv=False, nonative=False, python2=False,
+              pipelined=False, bundle=None):
     '''remoteIndex [ siteTop [ buildTop ] ]
     This command executes a complete build cycle:
       - (optional) delete all files in *siteTop*,
@@ -5261,15 +7561,27 @@ def pub_build(args, graph=False, clean=False,
     interaction.
     ex: dws build http://hostname/everything.git
     --graph        Generate a .dot graph of the dependencies
+                   and a Chrome-trace .json timeline of the build
+                   annotated with the critical path.
     --clean        Backup *siteTop* and remove all subdirectories
                    before executing a build command.
     --novirtualenv Install pure python packages in
                    the system paths.
     --nonative     Do not attempt to install native packages
                    (otherwise sudo permissions are required)
+    --pipelined    Install prerequisites through the different
+                   package managers (native, pip, gem, npm)
+                   concurrently.
+    --bundle       Install pip, apt and dnf packages from
+                   a directory created by `dws bundle`
+                   instead of downloading them.
     '''
     global USE_DEFAULT_ANSWER
     USE_DEFAULT_ANSWER = True
+    if bundle:
+        global BUNDLE_DIR
+        BUNDLE_DIR = os.path.abspath(bundle)
+        load_bundle(BUNDLE_DIR)
     CONTEXT.from_remote_index(args[0], nonative=nonative)
     # When CONTEXT.logDir is called before pub_build, the siteTop
     # will be set already.
@@ -5347,7 +7659,7 @@ def pub_build(args, graph=False, clean=False,
         shell_command([pip_executable,
             '--log-file', os.path.join(CONTEXT.value('buildTop'), 'pip.log'),
             '--cache-dir', CONTEXT.obj_dir('.cache/pip'),
-            'install', 'setuptools', '--upgrade'])
+            'install'] + pip_bundle_options() + ['setuptools', '--upgrade'])
 
     rgen = DerivedSetsGenerator()
     # If we do not force the update of the index file, the dependency
@@ -5363,7 +7675,7 @@ def pub_build(args, graph=False, clean=False,
         CONTEXT.environ['buildstamp'] = '-'.join([socket.gethostname(),
                                             stamp(datetime.datetime.now())])
     CONTEXT.save()
-    validate_controls(dgen, INDEX, graph=graph)
+    validate_controls(dgen, INDEX, graph=graph, pipelined=pipelined)
     # Once we have built the repository, let's report the results.
     # We stamp the logfile such that it gets a unique name.
     logstamp = stampfile(CONTEXT.logname())
@@ -5387,6 +7699,102 @@ def pub_build(args, graph=False, clean=False,
     return []
 
 
+def pip_bundle_options():
+    '''Returns the pip install options to only install packages
+    from *BUNDLE_DIR*.'''
+    if BUNDLE_DIR:
+        return ['--no-index', '--find-links', os.path.join(BUNDLE_DIR, 'pip')]
+    return []
+
+
+def load_bundle(bundle_dir):
+    '''Checks the files in *bundle_dir* match its manifest
+    and returns the manifest.'''
+    manifest_path = os.path.join(bundle_dir, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        raise Error("%s is not a bundle (no manifest.json)" % bundle_dir)
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    for pathname, sha1 in _iteritems(manifest.get('files', {})):
+        if _sha1sum(os.path.join(bundle_dir, pathname)) != sha1:
+            raise Error("%s: %s does not match the bundle manifest"
+                % (bundle_dir, pathname))
+    return manifest
+
+
+def pub_bundle(args, output='bundle'):
+    '''[ project ... ]
+    Downloads the packages installed through pip, apt or dnf
+    for *project* (by default all projects in the index),
+    and the packages they depend on, into an *output* directory
+    with a manifest.json. `dws build --bundle *output*` then installs
+    those packages without accessing the network.
+    --output   Directory to download the packages into.
+    '''
+    if args:
+        roots = args
+    else:
+        rgen = DerivedSetsGenerator()
+        INDEX.parse(rgen)
+        roots = rgen.roots
+    bundle_dir = os.path.abspath(output)
+    dgen = PubDepsGenerator(roots, [], exclude_pats=EXCLUDE_PATS)
+    manifest = {'created_at': datetime.datetime.now().isoformat(),
+                'distHost': CONTEXT.value('distHost'),
+                'roots': roots, 'packages': {}, 'files': {}}
+    if not os.path.isdir(os.path.join(bundle_dir, 'pip')):
+        os.makedirs(os.path.join(bundle_dir, 'pip'))
+    # virtualenvs created by `dws build` upgrade setuptools.
+    shell_command([find_pip(CONTEXT), 'download', '-d',
+        os.path.join(bundle_dir, 'pip'), 'setuptools'])
+    manifest['packages']['pip'] = ['setuptools']
+    for step in ordered_prerequisites(dgen, INDEX):
+        if isinstance(step, InstallStep):
+            installs = step.get_installs()
+            cmds = step.bundle_commands(installs, bundle_dir)
+            if not cmds:
+                log_info("warning: %s cannot be bundled and will be installed"
+                    " from the network." % ' '.join(installs))
+                continue
+            manager = (step.__class__.__name__.replace('InstallStep', '')
+                .lower())
+            if not os.path.isdir(os.path.join(bundle_dir, manager)):
+                os.makedirs(os.path.join(bundle_dir, manager))
+            for cmd, admin, noexecute in cmds:
+                shell_command(cmd, admin=admin, noexecute=noexecute)
+            manifest['packages'].setdefault(manager, [])
+            manifest['packages'][manager] += installs
+    for dirpath, _, filenames in os.walk(bundle_dir):
+        for filename in filenames:
+            pathname = os.path.join(dirpath, filename)
+            if pathname != os.path.join(bundle_dir, 'manifest.json'):
+                manifest['files'][os.path.relpath(pathname, bundle_dir)] = \
+                    _sha1sum(pathname)
+    with open(os.path.join(bundle_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    log_info("%d files bundled in %s" % (len(manifest['files']), bundle_dir))
+
+
+def pub_cache(args):
+    '''    gc
+    Manage the caches shared between workspaces.
+    `gc` evicts least recently used files from the asset store
+    (*assetStoreDir*) and the build artifacts cache (*artifactCacheDir*)
+    until they fit within *assetStoreSize* and *artifactCacheSize*.
+    '''
+    if len(args) < 1:
+        raise Error("usage: dws cache gc")
+    command = args[0]
+    if command == 'gc':
+        for name, cache in [('asset store', find_asset_store()),
+                            ('artifact cache', find_artifact_cache())]:
+            if cache is not None:
+                freed = cache.evict()
+                log_info("%s: %d bytes freed" % (name, freed))
+    else:
+        raise Error("unknown cache command '%s'" % command)
+
+
 def pub_collect(args, output=None):
     '''[ project ... ]
     Consolidate local dependencies information
@@ -5424,23 +7832,32 @@ def pub_collect(args, output=None):
                   'Fedora': (r'\.spec', r'\.rpm'),
                   'Debian': (r'\.dsc', r'\.deb'),
                   'Ubuntu': (r'\.dsc', r'\.deb')}
-    # collect index files and packages
+    # collect index files and packages in a single walk of the roots.
+    name_pats = {'index': CONTEXT.indexName, 'src_package': '.tar.bz2'}
+    if CONTEXT.host() in extensions:
+        name_pats['pkg_index'], name_pats['bin_package'] = \
+            extensions[CONTEXT.host()]
+    collected = find_files_by_pats(roots, name_pats)
     indices = []
-    for root in roots:
-        pre_exclude_indices = find_files(root, CONTEXT.indexName)
-        for index in pre_exclude_indices:
-            # We exclude any project index files that has been determined
-            # to be irrelevent to the collection being built.
-            found = False
-            if index == collected_index:
-                found = True
-            else:
-                for exclude_pat in EXCLUDE_PATS:
-                    if re.match('.*' + exclude_pat + '.*', index):
-                        found = True
-                        break
-            if not found:
-                indices += [index]
+    for index in collected['index']:
+        # We exclude any project index files that has been determined
+        # to be irrelevent to the collection being built.
+        found = False
+        if index == collected_index:
+            found = True
+        else:
+            for exclude_pat in EXCLUDE_PATS:
+                if re.match('.*' + exclude_pat + '.*', index):
+                    found = True
+                    break
+        if not found:
+            indices += [index]
+
+    def _under(paths, dirname):
+        if not [root for root in roots
+                if (dirname + os.sep).startswith(root + os.sep)]:
+            return None
+        return [path for path in paths if path.startswith(dirname + os.sep)]
 
     pkg_indices = []
     cpy_src_packages = None
@@ -5452,7 +7869,10 @@ def pub_collect(args, output=None):
         for index in indices:
             buildr = os.path.dirname(index.replace(CONTEXT.value('buildTop'),
                                                    CONTEXT.value('srcTop')))
-            src_packages = find_files(buildr, '.tar.bz2')
+            src_packages = _under(collected['src_package'], buildr)
+            if src_packages is None:
+                # *buildr* was not part of the walk.
+                src_packages = find_files(buildr, '.tar.bz2')
             if len(src_packages) > 0:
                 cmdline, prefix = find_rsync(
                     CONTEXT.remote_host(), context=CONTEXT)
@@ -5460,8 +7880,13 @@ def pub_collect(args, output=None):
                     ' '.join(src_packages), src_package_dir]
             if CONTEXT.host() in extensions:
                 ext = extensions[CONTEXT.host()]
-                pkg_indices += find_files(buildr, ext[0])
-                bin_packages = find_files(buildr, ext[1])
+                pkg_found = _under(collected['pkg_index'], buildr)
+                if pkg_found is None:
+                    pkg_found = find_files(buildr, ext[0])
+                pkg_indices += pkg_found
+                bin_packages = _under(collected['bin_package'], buildr)
+                if bin_packages is None:
+                    bin_packages = find_files(buildr, ext[1])
                 if len(bin_packages) > 0:
                     cmdline, prefix = find_rsync(
                         CONTEXT.remote_host(), context=CONTEXT)
@@ -5469,9 +7894,38 @@ def pub_collect(args, output=None):
                                                   package_dir]
 
     # Create the index and checks it is valid according to the schema.
-    create_index_pathname(collected_index, indices + pkg_indices)
-    shell_command(['xmllint', '--noout', '--schema ',
-                  CONTEXT.derived_helper('index.xsd'), collected_index])
+    # Project index files are validated in parallel and the results
+    # are cached by modification time, such that nothing is done
+    # when the workspace has not changed since the last collect.
+    # The cache is kept in *buildTop* such that it is not published
+    # along with the collected index.
+    collect_state = StateStore(os.path.join(
+        CONTEXT.value('buildTop'), '.dws-collect.json'))
+    inputs = []
+    for index in indices + pkg_indices:
+        stats = os.stat(index)
+        inputs += [[index, stats.st_mtime, stats.st_size]]
+    output_stamp = None
+    if os.path.isfile(collected_index):
+        stats = os.stat(collected_index)
+        output_stamp = [collected_index, stats.st_mtime, stats.st_size]
+    if (collect_state.get('inputs') != inputs
+        or output_stamp is None
+        or collect_state.get('output') != output_stamp):
+        schema = CONTEXT.derived_helper('index.xsd')
+        validate_indices(indices, schema, collect_state)
+        create_index_pathname(collected_index, indices + pkg_indices)
+        if pkg_indices:
+            # Package indices are not validated on their own.
+            shell_command(['xmllint', '--noout', '--schema ',
+                schema, collected_index])
+        stats = os.stat(collected_index)
+        collect_state.set('inputs', inputs)
+        collect_state.set('output',
+            [collected_index, stats.st_mtime, stats.st_size])
+        collect_state.save()
+    else:
+        log_info("%s is up-to-date." % collected_index)
     # We should only copy the index file after we created it.
     if copy_bin_packages:
         shell_command(copy_bin_packages)
@@ -5551,7 +8005,7 @@ def pub_deps(args, native=False):
             if not native or step.priority == Step.install_native:
                 cmds = step.install_commands(step.get_installs(), CONTEXT)
                 for cmd, admin, noexecute in cmds:
-                    sys.stdout.write("%s\n" % ' '.join(cmd))
+                    sys.stdout.write("%s\n" % shell_cmdline(cmd))
         elif isinstance(step, BuildStep):
             builds += [step.qualified_project_name()]
     if not native:
@@ -5582,7 +8036,8 @@ def pub_dockerfile(args):
                 cmds = step.install_commands(step.get_installs(), CONTEXT)
                 sep = ""
                 for cmd, _, _ in cmds:
-                    native_prerequisites += "%s%s" % (sep, ' '.join(cmd))
+                    native_prerequisites += "%s%s" % (
+                        sep, shell_cmdline(cmd))
                     sep = "\nRUN "
     sys.stdout.write(''.join(dockerfile_template) % {
         'native_prerequisites': native_prerequisites,
@@ -5705,6 +8160,44 @@ def pub_find(args):
         sys.exit(1)
 
 
+def pub_graph(args):
+    '''    rdeps|deps project
+    roots|leaves
+    Query the dependency graph of the projects in the index.
+    `rdeps project` lists the projects which depend (directly
+    or indirectly) on *project*, i.e. what a change to *project*
+    will rebuild. `deps project` lists the projects *project*
+    depends on. `roots` lists the projects no other project
+    depends on and `leaves` the ones without prerequisites.
+    '''
+    if len(args) < 1:
+        raise Error("usage: dws graph rdeps|deps|roots|leaves [project]")
+    graph = ProjectGraph()
+    INDEX.parse(graph)
+    command = args[0]
+    if command in ['rdeps', 'deps']:
+        if len(args) < 2:
+            raise Error("usage: dws graph %s project" % command)
+        names = set([])
+        for name in args[1:]:
+            if not (name in graph.forward or name in graph.reverse):
+                raise Error("unable to find " + name + " in the index file.",
+                            project_name=name)
+            if command == 'rdeps':
+                names |= graph.dependents(name)
+            else:
+                names |= graph.prerequisites(name)
+        names = sorted(names)
+    elif command == 'roots':
+        names = graph.roots
+    elif command == 'leaves':
+        names = graph.leaves
+    else:
+        raise Error("unknown graph command '%s'" % command)
+    for name in names:
+        sys.stdout.write(name + '\n')
+
+
 def pub_init(args):
     '''    Prompt for variables which have not been
     initialized in the workspace make fragment.
@@ -5782,7 +8275,7 @@ def pub_list(args):
     INDEX.parse(ListPdbHandler())
 
 
-def pub_make(args, graph=False):
+def pub_make(args, graph=False, force=False):
     """    Make projects. `make recurse` will build
     all dependencies required before a project
     can be itself built.
@@ -5791,6 +8284,10 @@ def pub_make(args, graph=False):
     source repositories nor download asset files.
     For a full-blown update/compile look at the `build`
     command.
+    `make recurse` skips projects whose sources, workspace
+    variables and prerequisites are unchanged since their last
+    successful make (recorded in *buildTop*/.dws-build.json).
+    --force        Run make on every project regardless.
     """
     # \todo That should not be required:
     # context.environ['siteTop'].default = os.path.dirname(os.path.dirname(
@@ -5818,6 +8315,10 @@ def pub_make(args, graph=False):
         else:
             CONTEXT.targets += [opt]
     if recurse:
+        if not force:
+            global BUILD_STATE
+            BUILD_STATE = BuildState(os.path.join(
+                CONTEXT.value('buildTop'), '.dws-build.json'))
         # note that *EXCLUDE_PATS* is global.
         validate_controls(
             MakeGenerator(roots, [], EXCLUDE_PATS), INDEX, graph=graph)
@@ -6218,6 +8719,8 @@ def main(args):
         import __main__
         import argparse
 
+        global WRITE_BEHIND
+        WRITE_BEHIND = True
         global CONTEXT
         CONTEXT = Context()
         keys = list(CONTEXT.environ.keys())
@@ -6261,7 +8764,7 @@ def main(args):
             help='Run as user')
         parser.add_argument('-g', '--group', dest='group', action='store',
             help='Run as group')
-        build_subcommands_parser(parser, __main__)
+        build_subcommands_parser(parser, __main__, args[1:])
 
         if len(args) <= 1:
             parser.print_help()
@@ -6329,6 +8832,8 @@ def main(args):
     except Error as err:
         log_error(str(err))
         exit_code = err.code
+    finally:
+        flush_contexts()
 
     if options.mailto and len(options.mailto) > 0 and LOG_PAT:
         logs = find_files(CONTEXT.log_path(''), LOG_PAT)
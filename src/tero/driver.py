@@ -299,7 +299,7 @@ def main(args, settings_path=None):
     parser.add_argument('-p', '--password', dest='password', default='vagrant')
     parser.add_argument('-k', '--keyfile', dest='keyfile',
         default=os.path.join(os.getenv('HOME'), '.ssh/vagrant_rsa'))
-    build_subcommands_parser(parser, sys.modules[__name__])
+    build_subcommands_parser(parser, sys.modules[__name__], args[1:])
 
     if len(args) <= 1:
         parser.print_help()